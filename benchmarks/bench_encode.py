@@ -0,0 +1,59 @@
+"""Compare to_json_bytes() with json.dumps(to_json()) on queries with thousands of leaves
+
+Run from the repository root with: python -m benchmarks.bench_encode
+"""
+
+import json
+import timeit
+
+from luxql import LuxAPI, LuxBoolean, LuxLeaf, LuxRelationship
+
+from .suite import clear_caches, peak_memory, pin_config
+
+
+def make_query(n):
+    api = LuxAPI("item")
+    top = LuxBoolean("OR", parent=api)
+    for i in range(n):
+        bl = LuxBoolean("AND", parent=top)
+        LuxLeaf("name", parent=bl, value=f"fish {i}", options=["stemmed"])
+        rel = LuxRelationship("producedBy", parent=bl)
+        LuxLeaf("name", parent=rel, value=f"artist {i}")
+    return api
+
+
+def run(sizes=(100, 1000, 5000), number=5):
+    pin_config()
+    results = {}
+    for n in sizes:
+        api = make_query(n)
+
+        def dicts():
+            clear_caches(api)
+            return json.dumps(api.to_json()).encode("utf-8")
+
+        def direct():
+            clear_caches(api)
+            return api.to_json_bytes()
+
+        assert dicts() == direct()
+        res = {}
+        for name, fn in (("dicts", dicts), ("direct", direct)):
+            res[name] = min(timeit.repeat(fn, number=number, repeat=3)) / number
+            res[f"{name}_peak"] = peak_memory(fn)
+        res["speedup"] = res["dicts"] / res["direct"]
+        results[n] = res
+    return results
+
+
+def main():
+    for n, res in run().items():
+        print(
+            f"{n:>5} leaf pairs  dumps(to_json) {res['dicts'] * 1e3:8.2f} ms {res['dicts_peak'] / 1024:8.1f} KiB  "
+            f"to_json_bytes {res['direct'] * 1e3:8.2f} ms {res['direct_peak'] / 1024:8.1f} KiB  "
+            f"x{res['speedup']:.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Memory used per query node, compared with the equivalent __dict__ based layout
+
+Run from the repository root with: python -m benchmarks.bench_memory
+"""
+
+import tracemalloc
+
+from luxql import LuxAPI, LuxBoolean, LuxLeaf, LuxRelationship
+
+
+class DictNode(object):
+    """Stand-in for the pre-slots layout: every attribute held in a per-instance __dict__"""
+
+    # Attributes in the order the old constructors assigned them, so that instance dicts share keys
+    attrs = (
+        "config",
+        "provides_scope",
+        "children",
+        "class_name",
+        "field",
+        "parent",
+        "requires_scope",
+        "possible_parent_scopes",
+        "possible_provides_scopes",
+        "complexity",
+        "value",
+        "comparitor",
+        "options",
+        "weight",
+        "complete",
+    )
+
+    def __init__(self, node):
+        for name in self.attrs:
+            if hasattr(node, name):
+                setattr(self, name, getattr(node, name))
+        # Each instance built its own list of provided scopes
+        self.possible_provides_scopes = list(node.possible_provides_scopes)
+
+
+def measure(make, n=10000):
+    """Return the average number of bytes retained by each result of make()"""
+    make()
+    tracemalloc.start()
+    keep = [make() for _ in range(n)]
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del keep
+    return current / n
+
+
+def run(n=10000):
+    LuxAPI("item")
+    makers = {
+        "leaf": lambda: LuxLeaf("name", value="fish"),
+        "boolean": lambda: LuxBoolean("AND"),
+        "relationship": lambda: LuxRelationship("carries"),
+    }
+    results = {}
+    for name, make in makers.items():
+        slotted = measure(make, n)
+        protos = [make() for _ in range(n)]
+        it = iter(protos)
+        dicted = measure(lambda: DictNode(next(it)), n - 1)
+        results[name] = {"slots": slotted, "dict": dicted, "saved": dicted - slotted}
+    return results
+
+
+def main():
+    for name, res in run().items():
+        print(
+            f"{name:<14} {res['slots']:8.1f} bytes/node (slots)  "
+            f"{res['dict']:8.1f} bytes/node (dict)  saved {res['saved']:6.1f} ({res['saved'] / res['dict']:.0%})"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""Compare the PLY and recursive descent backends of QueryParser
+
+Run from the repository root with: python -m benchmarks.bench_parser
+"""
+
+import timeit
+
+from luxql import QueryParser
+
+QUERIES = {
+    "short": "name:fish",
+    "medium": 'fish AND NOT creator->name:Smith AND (about->type:book OR format->medium:"digital")',
+    "long": " AND ".join(f'(carries->name:"boat {i}" OR producedDate>="19{i:02d}-01-01")' for i in range(50)),
+}
+
+
+def run(number=500):
+    parsers = {backend: QueryParser(backend=backend) for backend in ("ply", "descent")}
+    results = {}
+    for name, query in QUERIES.items():
+        n = max(1, number // max(1, len(query) // 50))
+        timings = {}
+        for backend, parser in parsers.items():
+            timings[backend] = min(timeit.repeat(lambda: parser.parse(query), number=n, repeat=3)) / n
+        timings["speedup"] = timings["ply"] / timings["descent"]
+        results[name] = timings
+    return results
+
+
+def main():
+    for name, res in run().items():
+        print(
+            f"{name:<8} ply {res['ply'] * 1e6:9.1f} us  descent {res['descent'] * 1e6:9.1f} us  "
+            f"x{res['speedup']:.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+"""Compare binding values to a prepared query with building and serialising the whole query
+
+Run from the repository root with: python -m benchmarks.bench_prepared
+"""
+
+import timeit
+
+from luxql import JsonReader, QueryParser
+from luxql.luxql import LuxScope
+
+from .suite import pin_config
+
+TEMPLATE = 'producedBy->name:$1 AND producedDate>=$2 AND (classification->name:$3 OR name:$3)'
+
+
+def run(number=2000, scope="item"):
+    pin_config()
+    parser = QueryParser()
+    reader = JsonReader(LuxScope.config)
+    prepared = parser.prepare(TEMPLATE, scope)
+    values = ("rembrandt", "1600-01-01", "painting")
+    query = TEMPLATE.replace("$1", values[0]).replace("$2", f'"{values[1]}"').replace("$3", values[2])
+    js = parser.make_query(query, scope).parent.to_json()
+    assert prepared.bind(*values, encoded=True) == parser.make_query(query, scope).parent.to_json(encoded=True)
+
+    timings = {
+        "make_query": lambda: parser.make_query(query, scope).parent.to_json(encoded=True),
+        "read": lambda: reader.read(js, scope).to_json(encoded=True),
+        "bind": lambda: prepared.bind(*values, encoded=True),
+    }
+    return {name: min(timeit.repeat(fn, number=number, repeat=3)) / number for name, fn in timings.items()}
+
+
+def main():
+    res = run()
+    for name, t in res.items():
+        print(f"{name:<12} {t * 1e6:8.2f} us  x{res[name] / res['bind']:.1f} bind")
+
+
+if __name__ == "__main__":
+    main()
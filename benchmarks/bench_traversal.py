@@ -0,0 +1,94 @@
+"""Compare the explicit-stack traversals with recursive equivalents on ordinary queries
+
+Run from the repository root with: python -m benchmarks.bench_traversal
+"""
+
+import timeit
+
+from luxql import JsonReader, QueryParser
+from luxql.luxql import LuxScope
+
+from .suite import CORPORA, clear_caches, generated_corpus, pin_config
+
+
+def recursive_to_json(node):
+    for x in node.children or ():
+        if x._json is None:
+            recursive_to_json(x)
+    node._json = node.build_json()
+    return node._json
+
+
+def recursive_complexity(node):
+    if node.complexity < 0:
+        node.complexity = node.own_complexity() + sum([recursive_complexity(x) for x in node.children or ()])
+    return node.complexity
+
+
+def recursive_to_luxql(ast, parent):
+    node, pending = ast.make_luxql(parent)
+    for sub, lux_parent in pending:
+        recursive_to_luxql(sub, lux_parent)
+    return node
+
+
+class RecursiveReader(JsonReader):
+    def read_query(self, query, parent):
+        node, subs = self.read_node(query, parent)
+        for sub, sub_parent in subs:
+            self.read_query(sub, sub_parent)
+        return node
+
+
+def run(number=200, scope="item"):
+    from luxql import LuxAPI
+
+    pin_config()
+    parser = QueryParser()
+    reader = JsonReader(LuxScope.config)
+    recursive_reader = RecursiveReader(LuxScope.config)
+    results = {}
+    for name, corpus in (("medium", CORPORA["medium"]), ("generated", generated_corpus())):
+        asts = [parser.run_parser(q) for q in corpus]
+        roots = [parser.make_query(q, scope).parent for q in corpus]
+        queries = [root.to_json() for root in roots]
+
+        def timed(fn):
+            return min(timeit.repeat(fn, number=number, repeat=7)) / number / len(corpus)
+
+        def uncached(fn):
+            def run_all():
+                for root in roots:
+                    clear_caches(root)
+                    fn(root)
+
+            return run_all
+
+        pairs = {
+            "to_json": (uncached(LuxScope.to_json), uncached(recursive_to_json)),
+            "complexity": (uncached(LuxScope.calculate_complexity), uncached(recursive_complexity)),
+            "read": (
+                lambda: [reader.read(q, scope) for q in queries],
+                lambda: [recursive_reader.read(q, scope) for q in queries],
+            ),
+            "to_luxql": (
+                lambda: [ast.to_luxql(LuxAPI(scope)) for ast in asts],
+                lambda: [recursive_to_luxql(ast, LuxAPI(scope)) for ast in asts],
+            ),
+        }
+        for op, (iterative, recursive) in pairs.items():
+            it, rec = timed(iterative), timed(recursive)
+            results[f"{name}.{op}"] = {"iterative": it, "recursive": rec, "ratio": rec / it}
+    return results
+
+
+def main():
+    for name, res in run().items():
+        print(
+            f"{name:<22} iterative {res['iterative'] * 1e6:8.2f} us  recursive {res['recursive'] * 1e6:8.2f} us  "
+            f"x{res['ratio']:.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
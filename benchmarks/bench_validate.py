@@ -0,0 +1,43 @@
+"""Compare JsonReader.validate() with building the tree through JsonReader.read()
+
+Run from the repository root with: python -m benchmarks.bench_validate
+"""
+
+import timeit
+
+from luxql import JsonReader, LuxAPI
+
+QUERIES = {
+    "leaf": {"name": "fish"},
+    "medium": {
+        "AND": [
+            {"name": "fish", "_options": ["punctuation-sensitive"]},
+            {"producedDate": "1900-01-01T00:00:00", "_comp": ">="},
+            {"OR": [{"carries": {"name": "painting"}}, {"classification": {"name": "sculpture"}}]},
+            {"NOT": [{"isOnline": "0"}]},
+        ]
+    },
+    "wide": {"OR": [{"producedBy": {"name": f"artist {i}"}} for i in range(200)]},
+}
+
+
+def run(number=200):
+    reader = JsonReader(LuxAPI("item").config)
+    results = {}
+    for name, query in QUERIES.items():
+        read = min(timeit.repeat(lambda: reader.read(query, "item"), number=number, repeat=3)) / number
+        validate = min(timeit.repeat(lambda: reader.validate(query, "item"), number=number, repeat=3)) / number
+        results[name] = {"read": read, "validate": validate, "speedup": read / validate}
+    return results
+
+
+def main():
+    for name, res in run().items():
+        print(
+            f"{name:<8} read {res['read'] * 1e6:9.1f} us  validate {res['validate'] * 1e6:9.1f} us  "
+            f"x{res['speedup']:.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
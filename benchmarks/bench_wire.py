@@ -0,0 +1,78 @@
+"""Compare the binary wire format with JSON for passing built queries between processes
+
+Size is the encoded length; encode is to_json_bytes() against wire.dumps(); decode is
+json.loads() and JsonReader.read() (which validates) against wire.loads() (which doesn't).
+Run from the repository root with: python -m benchmarks.bench_wire
+"""
+
+import json
+import timeit
+
+from luxql import JsonReader, wire
+from luxql.generator import QueryGenerator
+from luxql.luxql import LuxScope
+
+from .bench_encode import make_query
+from .suite import clear_caches, pin_config
+
+
+def corpora():
+    gen = QueryGenerator(LuxScope.config, seed=17, max_depth=4, option_rate=0.3)
+    reader = JsonReader(LuxScope.config)
+    generated = [reader.read(q, scope).parent for scope, q in gen.queries(200)]
+    return {"generated x200": generated, "wide x1": [make_query(1000)]}
+
+
+def run(number=5):
+    pin_config()
+    reader = JsonReader(LuxScope.config)
+    results = {}
+    for name, apis in corpora().items():
+        js = [api.to_json_bytes() for api in apis]
+        data = [wire.dumps(api) for api in apis]
+        for api, d in zip(apis, data):
+            assert wire.loads(d).to_json() == api.to_json()
+
+        def json_encode():
+            for api in apis:
+                clear_caches(api)
+                api.to_json_bytes()
+
+        def wire_encode():
+            for api in apis:
+                wire.dumps(api)
+
+        def json_decode():
+            for api, b in zip(apis, js):
+                reader.read(json.loads(b), api.provides_scope)
+
+        def wire_decode():
+            for d in data:
+                wire.loads(d)
+
+        res = {"json_size": sum(len(b) for b in js), "wire_size": sum(len(d) for d in data)}
+        for label, fn in (
+            ("json_encode", json_encode),
+            ("wire_encode", wire_encode),
+            ("json_decode", json_decode),
+            ("wire_decode", wire_decode),
+        ):
+            res[label] = min(timeit.repeat(fn, number=number, repeat=3)) / number
+        results[name] = res
+    return results
+
+
+def main():
+    for name, res in run().items():
+        print(
+            f"{name:<15} size json {res['json_size']:>8} B  wire {res['wire_size']:>8} B  "
+            f"x{res['json_size'] / res['wire_size']:.1f}"
+        )
+        for op in ("encode", "decode"):
+            j = res[f"json_{op}"]
+            w = res[f"wire_{op}"]
+            print(f"{'':<15} {op}   json {j * 1e3:8.2f} ms  wire {w * 1e3:8.2f} ms  x{j / w:.1f}")
+
+
+if __name__ == "__main__":
+    main()
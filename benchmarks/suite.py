@@ -0,0 +1,232 @@
+"""Offline benchmark suite: parse, build, read, complexity and serialise over fixed corpora
+
+Everything runs against the pinned search configuration shipped with the package and the
+statistics snapshot in benchmarks/data, so no network access is needed and results are
+comparable between runs. Results are checked against benchmarks/baseline.json.
+
+Throughput depends on the machine, so each run also times a fixed reference workload that
+doesn't use luxql, and throughput is compared relative to it: a baseline saved on a faster
+machine is scaled down rather than reported as a regression. The scaling is approximate, so
+when the tolerance is tight, regenerate the baseline on the machine doing the checking with --save.
+
+Run from the repository root with: python -m benchmarks.suite [--save] [--tolerance 0.25]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import luxql
+from luxql import JsonReader, LuxConfig, QueryParser
+from luxql.luxql import LuxScope, post_order
+from luxql.luxql import config as default_config
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(luxql.__file__)), "advanced-search-config.json")
+STATS_PATH = os.path.join(HERE, "data", "lux-stats.json")
+BASELINE_PATH = os.path.join(HERE, "baseline.json")
+
+CORPORA = {
+    "small": [
+        "fish",
+        "name:fish",
+        "carries->name:boat",
+        'producedDate>="1900-01-01"',
+        "name:fish AND isOnline:1",
+    ],
+    "medium": [
+        'fish AND NOT producedBy->name:Smith AND (carries->name:book OR material->name:"paper")',
+        'producedBy->name:rembrandt AND producedDate>="1600-01-01" AND producedDate<"1700-01-01"',
+        '(carries->name:"boat" OR carries->name:"ship") AND classification->name:painting AND NOT isOnline:0',
+        'producedBy->memberOf->name:"royal academy" AND (name:portrait OR name:landscape)',
+    ],
+    "pathological": [
+        # Deep relationship chain, deeply nested parentheses, and a very wide OR
+        "producedBy->" + "memberOf->" * 50 + "name:smith",
+        "(" * 50 + "name:a AND name:b" + " OR name:c)" * 50,
+        " OR ".join(f'producedBy->name:"artist {i}"' for i in range(200)),
+    ],
+}
+
+
+def generated_corpus(n=50, seed=17):
+    """Random query strings in item scope, from a fixed seed so runs are comparable"""
+    from luxql.generator import QueryGenerator
+
+    gen = QueryGenerator(LuxScope.config, seed=seed, max_depth=4, scopes=["item"], string_safe=True)
+    return [gen.query_string(q) for _, q in gen.queries(n)]
+
+
+def pin_config():
+    """Point every node at the pinned configuration and statistics, and return it"""
+    cfg = LuxConfig(default_config, lux_config=CONFIG_PATH, lux_stats=STATS_PATH)
+    LuxScope.config = cfg
+    return cfg
+
+
+def clear_caches(node):
+    """Drop the cached complexity and serialisation of every node in the tree, so they are recomputed"""
+    for x in post_order(node):
+        x.complexity = -1
+        x._json = None
+        x._json_bytes = None
+
+
+def build_luxy(luxy, js):
+    """Build the query in js with the luxy DSL"""
+    ((key, value),) = [(k, v) for k, v in js.items() if not k.startswith("_")]
+    if key in ("AND", "OR", "NOT"):
+        return getattr(luxy, key)(*[build_luxy(luxy, v) for v in value])
+    elif isinstance(value, dict):
+        return getattr(luxy, key)(build_luxy(luxy, value))
+    kw = {}
+    if "_comp" in js:
+        kw["comparitor"] = js["_comp"]
+    if "_options" in js:
+        kw["options"] = js["_options"]
+    return getattr(luxy, key)(value, **kw)
+
+
+def operations(corpus, scope="item"):
+    """The operations to time, each a function of no arguments that runs over the whole corpus"""
+    # After pin_config, as luxy reads the configuration on import
+    from luxql import luxy
+
+    parser = QueryParser()
+    reader = JsonReader(LuxScope.config)
+    apis = [parser.make_query(q, scope) for q in corpus]
+    # make_query returns the top level node; its parent is the LuxAPI
+    roots = [api.parent for api in apis]
+    queries = [api.to_json() for api in apis]
+
+    def complexity():
+        for root in roots:
+            clear_caches(root)
+            root.calculate_complexity()
+
+    def to_json():
+        for root in roots:
+            clear_caches(root)
+            root.to_json()
+
+    return {
+        "parse": lambda: [parser.run_parser(q) for q in corpus],
+        "make_query": lambda: [parser.make_query(q, scope) for q in corpus],
+        "read": lambda: [reader.read(q, scope) for q in queries],
+        "validate": lambda: [reader.validate(q, scope) for q in queries],
+        "luxy": lambda: [build_luxy(luxy, q) for q in queries],
+        "complexity": complexity,
+        "to_json": to_json,
+    }
+
+
+def reference():
+    """A fixed workload that doesn't touch luxql, timed in every run to scale throughput by"""
+    data = [{"name": f"fish {i}", "values": list(range(i % 20)), "nested": {"n": i}} for i in range(200)]
+    text = json.dumps(data)
+    for _ in range(5):
+        sorted(json.loads(text), key=lambda x: (len(x["values"]), x["name"]))
+
+
+def time_op(fn, min_time=0.2, repeat=3):
+    """Best ops/sec of repeat runs, each calling fn for at least min_time seconds"""
+    best = 0
+    for _ in range(repeat):
+        n = 0
+        start = time.perf_counter()
+        while True:
+            fn()
+            n += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        best = max(best, n / elapsed)
+    return best
+
+
+def peak_memory(fn):
+    """Peak bytes allocated during one call of fn"""
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run(min_time=0.2, repeat=3):
+    pin_config()
+    corpora = dict(CORPORA, generated=generated_corpus())
+    results = {"reference": {"ops": time_op(reference, min_time, repeat), "peak": 0}}
+    for name, corpus in corpora.items():
+        for op, fn in operations(corpus).items():
+            # Corpus passes per second, reported per query
+            results[f"{name}.{op}"] = {
+                "ops": time_op(fn, min_time, repeat) * len(corpus),
+                "peak": peak_memory(fn),
+            }
+    return results
+
+
+def speed(results, baseline):
+    """How much faster this machine ran the reference workload than the one the baseline came from"""
+    if "reference" in results and "reference" in baseline:
+        return results["reference"]["ops"] / baseline["reference"]["ops"]
+    return 1.0
+
+
+def compare(results, baseline, tolerance=0.25):
+    """Return the names of results more than tolerance slower, relative to the reference workload,
+    or using more memory, than baseline"""
+    scale = speed(results, baseline)
+    regressions = []
+    for name, res in results.items():
+        base = baseline.get(name)
+        if base is None or name == "reference":
+            continue
+        if res["ops"] < base["ops"] * scale * (1 - tolerance) or res["peak"] > base["peak"] * (1 + tolerance):
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--save", action="store_true", help="store the results as the new baseline")
+    ap.add_argument("--baseline", default=BASELINE_PATH)
+    ap.add_argument("--tolerance", type=float, default=0.25, help="allowed fractional slowdown")
+    ap.add_argument("--min-time", type=float, default=0.2, help="seconds per timing run")
+    args = ap.parse_args(argv)
+
+    results = run(args.min_time)
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+    regressions = compare(results, baseline, args.tolerance)
+    scale = speed(results, baseline)
+    if baseline:
+        print(f"Reference workload ran {scale:.2f}x as fast as for the baseline; throughput is scaled by it")
+
+    for name, res in results.items():
+        if name == "reference":
+            continue
+        line = f"{name:<26} {res['ops']:12.1f} q/s  peak {res['peak'] / 1024:9.1f} KiB"
+        if name in baseline:
+            line += f"  ({res['ops'] / (baseline[name]['ops'] * scale):5.2f}x baseline)"
+        if name in regressions:
+            line += "  REGRESSION"
+        print(line)
+
+    if args.save:
+        with open(args.baseline, "w") as fh:
+            json.dump(results, fh, indent=2, sort_keys=True)
+        print(f"Saved baseline to {args.baseline}")
+        return 0
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
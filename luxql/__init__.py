@@ -1,5 +1,6 @@
 from .luxql import LuxAPI, LuxLeaf, LuxBoolean, LuxRelationship, LuxConfig  # noqa
 from .reader import JsonReader  # noqa
 from .string_parser import QueryParser  # noqa
+from .optimizer import optimize  # noqa
 
-__all__ = ["LuxAPI", "LuxLeaf", "LuxBoolean", "LuxRelationship", "LuxConfig", "JsonReader"]
+__all__ = ["LuxAPI", "LuxLeaf", "LuxBoolean", "LuxRelationship", "LuxConfig", "JsonReader", "optimize"]
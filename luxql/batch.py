@@ -0,0 +1,78 @@
+"""Validate large numbers of queries across a pool of worker processes"""
+
+import itertools
+import multiprocessing
+import os
+from collections import deque
+
+from .luxql import LuxScope
+from .reader import JsonReader
+from .string_parser import QueryParser
+
+_reader = None
+_parser = None
+
+
+def _init_worker():
+    # Load the config once per process rather than once per query. Reading it only loads it if it
+    # isn't already, so forked workers keep the config in memory in the parent, however it got there
+    global _reader, _parser
+    LuxScope.config.scopes
+    _reader = JsonReader(LuxScope.config)
+    _parser = QueryParser()
+
+
+def check_query(query, scope):
+    """Build query (a JSON dict or a query string) and return (ok, error or json)"""
+    if _reader is None or _reader.config is not LuxScope.config:
+        _init_worker()
+    try:
+        if isinstance(query, str):
+            node = _parser.make_query(query, scope)
+        else:
+            node = _reader.read(query, scope)
+        # Both return the top query node, directly under the LuxAPI
+        return True, node.to_json()
+    except Exception as e:
+        return False, str(e)
+
+
+def _check_chunk(chunk, scope):
+    return [(i,) + check_query(q, scope) for i, q in chunk]
+
+
+def validate_many(queries, scope, workers=None, chunksize=200):
+    """Validate an iterable of queries, yielding (index, ok, error or json) in input order
+
+    Queries can be JSON dicts (built with JsonReader.read) or strings (built with
+    QueryParser.make_query). Chunks of queries are sent to a pool of `workers` processes,
+    defaulting to the number of CPUs; with workers=1 everything runs in this process.
+    Only a few chunks per worker are in flight at once, so the input can be a generator
+    over a file of any size.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    chunks = _chunked(enumerate(queries), chunksize)
+    if workers <= 1:
+        for chunk in chunks:
+            yield from _check_chunk(chunk, scope)
+        return
+
+    with multiprocessing.Pool(workers, initializer=_init_worker) as pool:
+        pending = deque()
+        for chunk in itertools.islice(chunks, workers * 2):
+            pending.append(pool.apply_async(_check_chunk, (chunk, scope)))
+        while pending:
+            results = pending.popleft().get()
+            for chunk in itertools.islice(chunks, 1):
+                pending.append(pool.apply_async(_check_chunk, (chunk, scope)))
+            yield from results
+
+
+def _chunked(iterable, size):
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
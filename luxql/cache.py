@@ -0,0 +1,76 @@
+"""Bounded LRU cache used to reuse parse results for repeated queries"""
+
+import threading
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class LRUCache(object):
+    """Least recently used cache with an optional time to live, safe to share between threads
+
+    If config is given, the cache is emptied whenever that LuxConfig is (re)loaded, as cached
+    results may no longer be valid for the new configuration.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, config=None):
+        if maxsize < 1:
+            raise ValueError("Cache size must be at least 1")
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.config = config
+        self.generation = None
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def check_generation(self):
+        if self.config is not None and self.config.generation != self.generation:
+            self.data.clear()
+            self.generation = self.config.generation
+
+    def get(self, key, default=MISSING):
+        """Return the value for key, or default if it isn't cached or has expired"""
+        with self.lock:
+            self.check_generation()
+            entry = self.data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires = entry
+            if expires is not None and expires < time.monotonic():
+                del self.data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.check_generation()
+            expires = time.monotonic() + self.ttl if self.ttl else None
+            self.data[key] = (value, expires)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        return {
+            "size": len(self.data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
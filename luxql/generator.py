@@ -0,0 +1,157 @@
+"""Random valid queries built from the terms in the LUX search configuration, for load and fuzz testing"""
+
+import random
+import re
+
+from .luxql import LuxAPI
+
+_word_re = re.compile(r"[\w.]+")
+
+
+class QueryGenerator(object):
+    """Generate random queries that are valid against a LuxConfig
+
+    Fields, relationship targets and options are all taken from the configuration's terms, so
+    every query can be read by JsonReader. The same seed always gives the same queries.
+
+    max_depth limits the nesting of booleans and relationships, max_breadth the number of
+    children of AND and OR. scopes is a list of scopes, or a dict of scope to weight, to pick
+    top level scopes from; leaf_types restricts leaves to some of text, date, float and boolean.
+    With string_safe, queries only use what the QueryParser syntax can express (relationships
+    lead to a single relationship or leaf, and there are no options) so that query_string() can
+    render all of them.
+    """
+
+    words = tuple(
+        "fish boat painting portrait landscape river yale smith gold silver map letter bird tree house ship horse "
+        "window book music".split()
+    )
+
+    def __init__(
+        self,
+        config=None,
+        seed=None,
+        max_depth=3,
+        max_breadth=3,
+        scopes=None,
+        leaf_types=None,
+        string_safe=False,
+        option_rate=0.2,
+    ):
+        self.config = config if config is not None else LuxAPI.config
+        self.random = random.Random(seed)
+        self.max_depth = max_depth
+        self.max_breadth = max(2, max_breadth)
+        self.leaf_types = tuple(leaf_types or self.config.module_config["leaf_scopes"])
+        self.string_safe = string_safe
+        self.option_rate = 0 if string_safe else option_rate
+        self.comparitors = list(self.config.module_config["comparitors"])
+
+        terms = self.config.lux_config["terms"]
+        self.leaves = {}
+        self.rels = {}
+        for scope in self.config.scopes:
+            self.leaves[scope] = sorted(f for f, t in terms[scope].items() if t["relation"] in self.leaf_types)
+            self.rels[scope] = sorted(
+                (f, t["relation"]) for f, t in terms[scope].items() if t["relation"] in terms
+            )
+
+        # Fewest relationships needed to reach an allowed leaf from each scope
+        self.reach = {s: 0 for s in self.config.scopes if self.leaves[s]}
+        changed = True
+        while changed:
+            changed = False
+            for scope, rels in self.rels.items():
+                for _, target in rels:
+                    if target in self.reach and self.reach[target] + 1 < self.reach.get(scope, max_depth + 1):
+                        self.reach[scope] = self.reach[target] + 1
+                        changed = True
+
+        if scopes is None:
+            scopes = self.config.scopes
+        if not isinstance(scopes, dict):
+            scopes = {s: 1 for s in scopes}
+        for s in scopes:
+            if s not in self.config.scopes:
+                raise ValueError(f"Unknown query scope '{s}'")
+        self.scopes = [s for s in scopes if self.reach.get(s, max_depth + 1) <= max_depth]
+        if not self.scopes:
+            raise ValueError("No scope can reach a leaf of the requested types within max_depth")
+        self.scope_weights = [scopes[s] for s in self.scopes]
+
+    def generate(self, scope=None):
+        """Return (scope, query) for a random query, in scope if given"""
+        if scope is None:
+            scope = self.random.choices(self.scopes, self.scope_weights)[0]
+        elif scope not in self.scopes:
+            raise ValueError(f"Can't generate queries in scope '{scope}'")
+        return scope, self.make_node(scope, self.max_depth)
+
+    def queries(self, n, scope=None):
+        """Yield n (scope, query) pairs"""
+        for _ in range(n):
+            yield self.generate(scope)
+
+    def make_node(self, scope, depth, boolean=True):
+        rnd = self.random
+        rels = [(f, t) for f, t in self.rels[scope] if self.reach.get(t, depth) < depth]
+        kinds = []
+        if self.leaves[scope]:
+            kinds.append("leaf")
+        if rels:
+            kinds.append("rel")
+        if boolean and depth > 0 and self.reach[scope] < depth:
+            kinds.append("bool")
+        kind = rnd.choice(kinds)
+
+        if kind == "leaf":
+            return self.make_leaf(scope, rnd.choice(self.leaves[scope]))
+        elif kind == "rel":
+            field, target = rnd.choice(rels)
+            return {field: self.make_node(target, depth - 1, not self.string_safe)}
+        op = rnd.choice(("AND", "OR", "NOT"))
+        n = 1 if op == "NOT" else rnd.randint(2, self.max_breadth)
+        return {op: [self.make_node(scope, depth - 1) for _ in range(n)]}
+
+    def make_leaf(self, scope, field):
+        rnd = self.random
+        term = self.config.lux_config["terms"][scope][field]
+        relation = term["relation"]
+        if relation == "text":
+            js = {field: " ".join(rnd.sample(self.words, rnd.randint(1, 2)))}
+            if self.option_rate and rnd.random() < self.option_rate and "allowedOptionsName" in term:
+                allowed = self.config.lux_config["options"][term["allowedOptionsName"]]["allowed"]
+                js["_options"] = rnd.sample(allowed, min(len(allowed), rnd.randint(1, 2)))
+        elif relation == "date":
+            year = rnd.randint(1000, 2020)
+            js = {field: f"{year:04d}-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}T00:00:00"}
+            js["_comp"] = rnd.choice(self.comparitors)
+        elif relation == "float":
+            js = {field: str(round(rnd.uniform(0, 500), 1)), "_comp": rnd.choice(self.comparitors)}
+        else:
+            js = {field: rnd.choice(("0", "1"))}
+        return js
+
+    def query_string(self, query):
+        """Render a query as a QueryParser string; raises ValueError if the syntax can't express it"""
+        ((key, value),) = [(k, v) for k, v in query.items() if not k.startswith("_")]
+        if key in ("AND", "OR", "NOT"):
+            parts = [self.query_string(q) for q in value]
+            parts = [f"({p})" if "AND" in q or "OR" in q or "NOT" in q else p for p, q in zip(parts, value)]
+            if key == "NOT":
+                if len(parts) != 1:
+                    raise ValueError("Query strings can only negate a single clause")
+                return f"NOT {parts[0]}"
+            return f" {key} ".join(parts)
+        elif isinstance(value, dict):
+            if "AND" in value or "OR" in value or "NOT" in value:
+                raise ValueError(f"Relationship {key} must lead to a relationship or leaf in a query string")
+            return f"{key}->{self.query_string(value)}"
+        if "_options" in query:
+            raise ValueError("Query strings can't express options")
+        value = str(value)
+        if not _word_re.fullmatch(value) or value.startswith(("AND", "OR", "NOT")):
+            if '"' in value:
+                raise ValueError("Query strings can't express values containing double quotes")
+            value = f'"{value}"'
+        return f"{key}{query.get('_comp', ':')}{value}"
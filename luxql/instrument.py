@@ -0,0 +1,156 @@
+"""Optional per-stage timings and counters for query handling
+
+The stages are lex, parse, to_luxql, validation, complexity and to_json. Nothing is recorded,
+and instrumented code only pays for a check of `enabled`, until a recorder is installed,
+either for the current thread:
+
+    with instrument.recording() as rec:
+        parser.make_query(q, "item").to_json()
+    rec.as_dict()
+
+or for the whole process with add_recorder(). Anything with add_time(stage, seconds) and
+count(name, n) methods can be installed, e.g. to forward to a metrics system. Stages nest
+(to_luxql includes validation); only the outermost call of a recursive stage is timed.
+"""
+
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter
+
+# Checked by instrumented code before anything else
+enabled = False
+
+# Upper bounds, in seconds, of the histogram buckets
+DEFAULT_BUCKETS = (1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1.0)
+
+_local = threading.local()
+_recorders = []
+_thread_recorders = 0
+_lock = threading.Lock()
+
+
+class Recorder(object):
+    """Accumulates stage timings, with a histogram per stage, and counters"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # stage -> [count, total, max, bucket counts]
+            self.stages = {}
+            self.counters = {}
+
+    def add_time(self, stage, seconds):
+        with self.lock:
+            st = self.stages.get(stage)
+            if st is None:
+                st = self.stages[stage] = [0, 0.0, 0.0, [0] * (len(self.buckets) + 1)]
+            st[0] += 1
+            st[1] += seconds
+            if seconds > st[2]:
+                st[2] = seconds
+            st[3][bisect_left(self.buckets, seconds)] += 1
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def as_dict(self):
+        """Count, total, mean and max seconds per stage, and the counters"""
+        with self.lock:
+            stages = {
+                name: {"count": c, "total": total, "mean": total / c, "max": mx}
+                for name, (c, total, mx, _) in self.stages.items()
+            }
+            return {"stages": stages, "counters": dict(self.counters)}
+
+    def histograms(self):
+        """Per stage, the bucket upper bounds ("le", the last being None for unbounded) and counts"""
+        bounds = list(self.buckets) + [None]
+        with self.lock:
+            return {name: {"le": bounds, "counts": list(st[3])} for name, st in self.stages.items()}
+
+
+def _update_enabled():
+    global enabled
+    enabled = bool(_recorders) or _thread_recorders > 0
+
+
+def add_recorder(recorder):
+    """Send every thread's timings and counts to recorder, until remove_recorder()"""
+    with _lock:
+        _recorders.append(recorder)
+        _update_enabled()
+    return recorder
+
+
+def remove_recorder(recorder):
+    with _lock:
+        _recorders.remove(recorder)
+        _update_enabled()
+
+
+@contextmanager
+def recording(recorder=None):
+    """Record the current thread's timings and counts into recorder (a new Recorder by default)"""
+    global _thread_recorders
+    if recorder is None:
+        recorder = Recorder()
+    previous = getattr(_local, "recorder", None)
+    _local.recorder = recorder
+    with _lock:
+        _thread_recorders += 1
+        _update_enabled()
+    try:
+        yield recorder
+    finally:
+        _local.recorder = previous
+        with _lock:
+            _thread_recorders -= 1
+            _update_enabled()
+
+
+def _targets():
+    local = getattr(_local, "recorder", None)
+    if local is None:
+        return _recorders
+    return [local] + _recorders
+
+
+def count(name, n=1):
+    for r in _targets():
+        r.count(name, n)
+
+
+class stage(object):
+    """Context manager timing a stage; failures are counted as <stage>_errors"""
+
+    __slots__ = ("name", "start", "outer")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        try:
+            active = _local.active
+        except AttributeError:
+            active = _local.active = set()
+        self.outer = self.name not in active
+        if self.outer:
+            active.add(self.name)
+            self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.outer:
+            elapsed = perf_counter() - self.start
+            _local.active.discard(self.name)
+            for r in _targets():
+                r.add_time(self.name, elapsed)
+                if exc_type is not None:
+                    r.count(f"{self.name}_errors")
+        return False
@@ -0,0 +1,10 @@
+# lextab.py. This file automatically created by PLY (version 3.11). Don't edit!
+_tabversion   = '3.10'
+_lextokens    = set(('AND', 'ARROW', 'COLON', 'COMPARATOR', 'LPAREN', 'NOT', 'OR', 'QUOTED_STRING', 'RPAREN', 'WORD'))
+_lexreflags   = 64
+_lexliterals  = ''
+_lexstateinfo = {'INITIAL': 'inclusive'}
+_lexstatere   = {'INITIAL': [('(?P<t_AND>AND)|(?P<t_OR>OR)|(?P<t_NOT>NOT)|(?P<t_LPAREN>\\()|(?P<t_RPAREN>\\))|(?P<t_COLON>:)|(?P<t_QUOTED_STRING>"[^"]*")|(?P<t_WORD>[\\w._0-9]+)|(?P<t_ARROW>->)|(?P<t_COMPARATOR>>=|<=|==|!=|>|<|=)|(?P<t_newline>\\n+)', [None, ('t_AND', 'AND'), ('t_OR', 'OR'), ('t_NOT', 'NOT'), ('t_LPAREN', 'LPAREN'), ('t_RPAREN', 'RPAREN'), ('t_COLON', 'COLON'), ('t_QUOTED_STRING', 'QUOTED_STRING'), ('t_WORD', 'WORD'), ('t_ARROW', 'ARROW'), ('t_COMPARATOR', 'COMPARATOR'), ('t_newline', 'newline')])]}
+_lexstateignore = {'INITIAL': ' \t'}
+_lexstateerrorf = {'INITIAL': 't_error'}
+_lexstateeoff = {}
@@ -1,8 +1,16 @@
+import hashlib
 import json
 import os
 import re
+import threading
+import time
+import warnings
+from collections import namedtuple
+from json.encoder import encode_basestring_ascii
+from types import MappingProxyType
 
-import requests
+from . import instrument
+from .transport import shared_transport
 
 config = dict(
     lux_base="https://lux.collections.yale.edu/api/",
@@ -13,115 +21,567 @@ config = dict(
     leaf_scopes=["text", "date", "float", "boolean"],
     cache_remote_config=True,
     cache_remote_stats=False,
+    allow_network=False,
+    snapshot_dir=None,
+    snapshot_ttl=86400,
+    http_pool_size=10,
+    http_timeout=10,
+)
+
+SNAPSHOT_VERSION = 1
+
+
+def _encode_value(value):
+    # As json.dumps(value), with a fast path for the usual strings
+    if type(value) is str:
+        return encode_basestring_ascii(value)
+    return json.dumps(value)
+
+
+# Compiled view of one (parent scope, field) entry of the advanced search config
+TermInfo = namedtuple(
+    "TermInfo", ["scope", "field", "relation", "is_leaf", "options_name", "options", "comparitors"]
+)
+# Where a field can appear and what it can provide, across all scopes
+FieldInfo = namedtuple("FieldInfo", ["parent_scopes", "provides_scopes", "bad_leaf_scope", "bad_rel_scope"])
+# Everything compiled from one load of the advanced search config. A reload builds a new one and swaps it
+# in whole, so code that reads config.state once sees a single generation throughout.
+ConfigState = namedtuple(
+    "ConfigState",
+    [
+        "generation",
+        "lux_config",
+        "scopes",
+        "valid_date_re",
+        "inverted",
+        "terms",
+        "possible_options",
+        "index",
+        "fields",
+        "relation_info",
+    ],
 )
 
 
 class LuxConfig(object):
-    """Handler for retrieving and processing the LUX search configuration"""
+    """Handler for retrieving and processing the LUX search configuration
 
-    def __init__(self, config=config, lux_config=""):
-        self.module_config = config
-        if not lux_config:
-            lux_config = os.path.join(os.path.dirname(__file__), f"{config['lux_config']}.json")
-        if not os.path.exists(lux_config):
-            lux_config = ""
+    Nothing is read until first use: the search configuration and the statistics are
+    loaded from on-disk snapshots, and only fetched from the LUX API when the module
+    config sets `allow_network` and the snapshot is missing or older than `snapshot_ttl`.
+    Fetches go through `transport` (see luxql.transport), by default a pooled session shared
+    by every LuxConfig in the process.
+    """
+
+    # Read from the current state, for code that only needs one of them
+    _config_attrs = ConfigState._fields[1:]
 
+    def __init__(self, config=config, lux_config="", lux_stats="", transport=None):
+        self.module_config = config
+        self.transport = transport or shared_transport(
+            config.get("http_pool_size", 10), config.get("http_timeout", 10)
+        )
+        self.possible_comparitors = config["comparitors"]
         self.remote_lux_config = f"{config['lux_base']}{config['lux_config']}"
         self.remote_lux_stats = f"{config['lux_base']}{config['lux_stats']}"
 
-        # read from disk
-        if lux_config:
-            with open(lux_config) as fh:
-                js = json.load(fh)
-            self.lux_config = js
-        elif self.remote_lux_config:
-            # Read from remote LUX instance
-            try:
-                resp = requests.get(self.remote_lux_config, timeout=10)
-                if resp.status_code == 200:
-                    self.lux_config = resp.json()
-                    if config["cache_remote_config"]:
-                        fn = os.path.join(os.path.dirname(__file__), "advanced-search-config.json")
-                        with open(fn, "w") as fh:
-                            fh.write(json.dumps(self.lux_config, indent=2))
-                else:
-                    raise ValueError(f"Couldn't retrieve configuration from {self.remote_lux_config}")
-            except Exception:
-                raise
-        if self.remote_lux_stats:
-            try:
-                resp = requests.get(self.remote_lux_stats, timeout=10)
-                if resp.status_code == 200:
-                    self.lux_stats = resp.json()
-                    if config["cache_remote_stats"]:
-                        fn = os.path.join(os.path.dirname(__file__), "stats.json")
-                        with open(fn, "w") as fh:
-                            fh.write(json.dumps(self.lux_stats, indent=2))
-                else:
-                    raise ValueError(f"Couldn't retrieve statistics from {self.remote_lux_stats}")
-            except Exception:
-                raise
+        snapshot_dir = config.get("snapshot_dir") or os.path.dirname(__file__)
+        # Explicitly given files are pinned and never refreshed
+        self.pinned_config = bool(lux_config)
+        self.pinned_stats = bool(lux_stats)
+        self.lux_config_path = lux_config or os.path.join(snapshot_dir, f"{config['lux_config']}.json")
+        self.lux_stats_path = lux_stats or os.path.join(snapshot_dir, f"{config['lux_stats']}.json")
+        self.load_lock = threading.RLock()
+        # ETag / Last-Modified per URL, for conditional requests
+        self.validators = {}
+
+    def __getattr__(self, name):
+        # Only called when the attribute isn't set yet, so no cost once loaded
+        if name in LuxConfig._config_attrs:
+            return getattr(self.state, name)
+        elif name == "state":
+            with self.load_lock:
+                # Another thread may have finished loading while we waited
+                if name not in self.__dict__:
+                    self.load_config()
+        elif name == "lux_stats":
+            with self.load_lock:
+                if name not in self.__dict__:
+                    self.load_stats()
         else:
-            # No configuration provided, fail
-            raise ValueError("No data statistics provided or available")
+            raise AttributeError(f"'{self.__class__.__name__}' object has no attribute '{name}'")
+        return self.__dict__[name]
 
-        self.scopes = list(self.lux_config["terms"].keys())
+    def load_config(self):
+        """Load the advanced search configuration and build the derived lookups"""
+        with self.load_lock:
+            prefetched = {}
+            if "lux_stats" not in self.__dict__ and self.needs_fetch(self.lux_config_path, self.pinned_config):
+                # Going to the network anyway, so fetch the stats at the same time if they'll need it
+                if self.needs_fetch(self.lux_stats_path, self.pinned_stats):
+                    prefetched = self.fetch_many([self.remote_lux_config, self.remote_lux_stats])
+            self.process_config(
+                self.load_resource(
+                    "configuration",
+                    self.lux_config_path,
+                    self.remote_lux_config,
+                    self.pinned_config,
+                    self.module_config.get("cache_remote_config", False),
+                    prefetched.get(self.remote_lux_config),
+                )
+            )
+            if prefetched:
+                self.load_stats(prefetched.get(self.remote_lux_stats))
 
-        # The format is 'YYYY-MM-DDThh:mm:ss.000Z' or '-YYYYYY-MM-DDThh:mm:ss.000Z'
-        self.valid_date_re = re.compile(
-            r"((-[0-9][0-9])?[0-9]{4})(-[0-1][0-9]-[0-3][0-9](T[0-2][0-9]:[0-5][0-9]:[0-5][0-9])?)?"
-        )
+    def load_stats(self, remote=None):
+        """Load the data statistics used for complexity estimates
+
+        The package ships a snapshot. If the snapshot in use is missing and can't be fetched, every
+        scope gets the same estimate, with a warning: complexity can still be calculated, only without
+        weighting relationships by the size of the scopes they join
+        """
+        with self.load_lock:
+            try:
+                self.lux_stats = self.load_resource(
+                    "statistics",
+                    self.lux_stats_path,
+                    self.remote_lux_stats,
+                    self.pinned_stats,
+                    self.module_config.get("cache_remote_stats", False),
+                    remote,
+                )
+            except ValueError:
+                if self.pinned_stats or os.path.exists(self.lux_stats_path):
+                    raise
+                warnings.warn(
+                    f"No statistics snapshot at {self.lux_stats_path}; complexity estimates will not be "
+                    "weighted by the size of each scope",
+                    stacklevel=2,
+                )
+                self.lux_stats = {"estimates": {"searchScopes": {}}}
+
+    def reload(self):
+        """Load the configuration again, and the statistics on their next use"""
+        with self.load_lock:
+            self.__dict__.pop("lux_stats", None)
+            self.load_config()
+
+    @property
+    def generation(self):
+        """Incremented on every (re)load, so that caches of derived results can tell they're stale"""
+        state = self.__dict__.get("state")
+        return state.generation if state is not None else 0
 
-        self.inverted = {}
-        self.terms = {"leaf": set([]), "rel": set([])}
-        for scope, terms in self.lux_config["terms"].items():
-            for t in terms.keys():
+    def process_config(self, js):
+        self.swap_state(self.compile_config(js))
+
+    def swap_state(self, state):
+        # Everything derived from the config is built first and then swapped in with a single assignment,
+        # so nodes being validated in other threads never see a mix of old and new
+        with self.load_lock:
+            self.state = state._replace(generation=self.generation + 1)
+
+    def compile_config(self, js):
+        """Build the lookups derived from the advanced search config js, returned as a ConfigState"""
+        scopes = tuple(js["terms"].keys())
+
+        inverted = {}
+        terms = {"leaf": set([]), "rel": set([])}
+        for scope, sterms in js["terms"].items():
+            for t in sterms.keys():
                 try:
-                    self.inverted[t].append(scope)
+                    inverted[t].append(scope)
                 except Exception:
-                    self.inverted[t] = [scope]
-                relt = terms[t]["relation"]
-                if relt in self.scopes:
-                    self.terms["rel"].add(t)
+                    inverted[t] = [scope]
+                relt = sterms[t]["relation"]
+                if relt in scopes:
+                    terms["rel"].add(t)
                 else:
-                    self.terms["leaf"].add(t)
+                    terms["leaf"].add(t)
 
-        self.possible_options = {}
-        for k in self.lux_config["options"].values():
+        possible_options = {}
+        for k in js["options"].values():
             for o in k["allowed"]:
-                self.possible_options[o] = 1
+                possible_options[o] = 1
 
-        self.possible_comparitors = config["comparitors"]
+        return ConfigState(
+            generation=0,
+            lux_config=js,
+            scopes=scopes,
+            # The format is 'YYYY-MM-DDThh:mm:ss.000Z' or '-YYYYYY-MM-DDThh:mm:ss.000Z'
+            valid_date_re=re.compile(
+                r"((-[0-9][0-9])?[0-9]{4})(-[0-1][0-9]-[0-3][0-9](T[0-2][0-9]:[0-5][0-9]:[0-5][0-9])?)?"
+            ),
+            inverted=MappingProxyType({k: tuple(v) for k, v in inverted.items()}),
+            terms=MappingProxyType({k: frozenset(v) for k, v in terms.items()}),
+            possible_options=frozenset(possible_options),
+            **self.compile_index(js, scopes, inverted),
+        )
+
+    def compile_index(self, js, scope_list, inverted):
+        """Compile the terms into frozen lookups keyed on (scope, field) and field"""
+        scopes = frozenset(scope_list)
+        leaf_scopes = frozenset(self.module_config["leaf_scopes"])
+        comparitors = frozenset(self.module_config["comparitors"])
+        options = {k: frozenset(v["allowed"]) for k, v in js["options"].items()}
+
+        def make_info(scope, field, relation, options_name=None):
+            return TermInfo(
+                scope,
+                field,
+                relation,
+                relation not in scopes,
+                options_name,
+                options.get(options_name) if relation == "text" else None,
+                comparitors if relation in ("date", "float") else None,
+            )
+
+        index = {}
+        fields = {}
+        for scope, terms in js["terms"].items():
+            for field, info in terms.items():
+                index[(scope, field)] = make_info(scope, field, info["relation"], info.get("allowedOptionsName"))
+        for field, parents in inverted.items():
+            provides = []
+            for s in parents:
+                prov = js["terms"][s][field]["relation"]
+                if prov not in provides:
+                    provides.append(prov)
+            bad_leaf = [s for s in provides if s not in leaf_scopes]
+            bad_rel = [s for s in provides if s not in scopes]
+            fields[field] = FieldInfo(
+                tuple(parents), tuple(provides), bad_leaf[0] if bad_leaf else None, bad_rel[0] if bad_rel else None
+            )
+
+        return dict(
+            index=MappingProxyType(index),
+            fields=MappingProxyType(fields),
+            # Scope-independent checks, for leaves that don't know their parent yet
+            relation_info=MappingProxyType({s: make_info(None, None, s) for s in tuple(leaf_scopes) + scope_list}),
+        )
+
+    def refresh(self):
+        """Fetch the configuration and statistics again if they've changed, and swap them in
+
+        Conditional requests (ETag / If-Modified-Since) are used, so unchanged resources are cheap.
+        The new config is compiled before being swapped in, so callers are never blocked by the
+        network. Pinned files are not refreshed. Returns True if anything changed.
+        """
+        changed = False
+        urls = []
+        if not self.pinned_config:
+            urls.append(self.remote_lux_config)
+        if not self.pinned_stats:
+            urls.append(self.remote_lux_stats)
+        fetched = self.fetch_many(urls, conditional=True)
+
+        # Whatever was fetched successfully is applied before any failure is raised, as its
+        # validators are already stored and a later refresh would get a 304 for it
+        error = None
+        for url, js in fetched.items():
+            if js is None:
+                continue
+            try:
+                if isinstance(js, Exception):
+                    raise js
+                if url == self.remote_lux_config:
+                    self.swap_state(self.compile_config(js))
+                    if self.module_config.get("cache_remote_config", False):
+                        self.write_snapshot(self.lux_config_path, url, js)
+                else:
+                    self.lux_stats = js
+                    if self.module_config.get("cache_remote_stats", False):
+                        self.write_snapshot(self.lux_stats_path, url, js)
+                changed = True
+            except Exception as e:
+                if not isinstance(js, Exception):
+                    # Not applied, so it must be fetched in full next time
+                    self.validators.pop(url, None)
+                error = error or e
+        if error is not None:
+            raise error
+        return changed
+
+    def needs_fetch(self, path, pinned):
+        """Whether loading the resource snapshotted at path would go to the network"""
+        if pinned or not self.module_config.get("allow_network", False):
+            return False
+        data, fetched = self.read_snapshot(path)
+        ttl = self.module_config.get("snapshot_ttl")
+        return data is None or bool(ttl and time.time() - fetched >= ttl)
+
+    def load_resource(self, what, path, url, pinned, cache, remote=None):
+        """Return the snapshot at path, refreshing it from url only if allowed and stale
+
+        remote, if given, is the result of an earlier fetch of url (data, or the exception raised)
+        """
+        data, fetched = self.read_snapshot(path)
+        if pinned:
+            if data is None:
+                raise ValueError(f"Couldn't read {what} from {path}")
+            return data
+
+        ttl = self.module_config.get("snapshot_ttl")
+        fresh = data is not None and (not ttl or time.time() - fetched < ttl)
+        if fresh or not self.module_config.get("allow_network", False):
+            if data is None:
+                raise ValueError(f"No {what} snapshot at {path} and network access is not allowed")
+            return data
+
+        try:
+            if remote is None:
+                remote = self.fetch(url)
+            elif isinstance(remote, Exception):
+                raise remote
+        except Exception:
+            if data is not None:
+                # Stale is better than nothing
+                return data
+            raise
+        if cache:
+            self.write_snapshot(path, url, remote)
+        return remote
+
+    def fetch(self, url, conditional=False):
+        """Fetch JSON from url; if conditional, return None when it hasn't changed since the last fetch"""
+        headers = {}
+        if conditional:
+            known = self.validators.get(url, {})
+            if "ETag" in known:
+                headers["If-None-Match"] = known["ETag"]
+            if "Last-Modified" in known:
+                headers["If-Modified-Since"] = known["Last-Modified"]
+        status, resp_headers, data = self.transport.get(url, headers)
+        if conditional and status == 304:
+            return None
+        elif status != 200:
+            raise ValueError(f"Couldn't retrieve {url}: {status}")
+        self.validators[url] = {k: resp_headers[k] for k in ("ETag", "Last-Modified") if k in resp_headers}
+        return data
+
+    def fetch_many(self, urls, conditional=False):
+        """Fetch urls concurrently, returning a dict of url to data (or the exception raised)"""
+
+        def fetch_one(url):
+            try:
+                return self.fetch(url, conditional)
+            except Exception as e:
+                return e
+
+        if len(urls) < 2:
+            return {url: fetch_one(url) for url in urls}
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(len(urls)) as pool:
+            return dict(zip(urls, pool.map(fetch_one, urls)))
+
+    def read_snapshot(self, path):
+        """Return (data, fetch time) from a snapshot file, or (None, 0) if there isn't one"""
+        try:
+            with open(path) as fh:
+                js = json.load(fh)
+        except (OSError, ValueError):
+            return None, 0
+        if isinstance(js, dict) and "snapshot_version" in js:
+            if js["snapshot_version"] != SNAPSHOT_VERSION:
+                return None, 0
+            if js.get("validators"):
+                self.validators.setdefault(js["source"], js["validators"])
+            return js["data"], js["fetched"]
+        # A bare JSON document, e.g. the config shipped with the package
+        return js, os.path.getmtime(path)
+
+    def write_snapshot(self, path, url, data):
+        js = {
+            "snapshot_version": SNAPSHOT_VERSION,
+            "fetched": time.time(),
+            "source": url,
+            "validators": self.validators.get(url, {}),
+            "data": data,
+        }
+        tmp = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "w") as fh:
+                fh.write(json.dumps(js, indent=2))
+            os.replace(tmp, path)
+        except OSError:
+            # Read-only install; the data is still in memory for this process
+            if os.path.exists(tmp):
+                os.remove(tmp)
 
 
 _cached_lux_config = LuxConfig(config)
 
 
+def post_order(node, descend=None):
+    """The nodes of the tree at node, each after its children and in the order they were added
+
+    The tree is walked with an explicit stack rather than recursion, so it can be of any depth. With
+    descend, only children for which descend(child) is true are included, along with their subtrees.
+    """
+    # Collected parents first, with the last child first, then reversed
+    order = []
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        order.append(node)
+        if node.children:
+            stack.extend(node.children if descend is None else filter(descend, node.children))
+    order.reverse()
+    return order
+
+
+# The _json_bytes of nodes under one whose encoding is cached; never valid JSON, so never returned
+_ENCODED_ABOVE = b""
+# The complexity of nodes whose cached complexity was dropped in a tree with a budget
+_RECHECK = -2
+
+
 class LuxScope(object):
     """Abstract base class for both the API and the Query language, as the API also needs a scope and children"""
 
+    # Nodes are slotted as large batches of parsed queries are kept in memory
+    __slots__ = ("provides_scope", "children", "complexity", "_json", "_json_bytes")
+    config = _cached_lux_config
+    # Only an API can have a complexity budget
+    budget = None
+
     def __init__(self, scope):
-        self.config = _cached_lux_config
         if scope and scope not in self.config.scopes:
             raise ValueError(f"Unknown scope {scope}; valid scopes are {', '.join(self.config.scopes)}")
+        self._init_fields(scope)
+
+    def _init_fields(self, scope):
+        # Set every slot, without any checks; shared by the constructors and _restore
         self.provides_scope = scope
         self.children = []
+        self.complexity = -1
+        self._json = None
+        self._json_bytes = None
 
     def add(self, what):
         # Actually add and do a callback
+        if instrument.enabled:
+            instrument.count("nodes")
         self.children.append(what)
+        what.parent = self
         what.added_to(self)
+        self.invalidate(complexity=False)
+        if self.complexity >= 0:
+            self.add_complexity(what.calculate_complexity())
+        elif self.complexity == _RECHECK:
+            # The tree has a budget but its complexity was dropped, so calculate it all again to check it
+            root = self
+            while getattr(root, "parent", None) is not None:
+                root = root.parent
+            root.calculate_complexity()
+
+    def add_complexity(self, delta):
+        # Keep already calculated complexities current as the tree grows, in O(depth)
+        node = self
+        root = None
+        while node is not None and node.complexity >= 0:
+            node.complexity += delta
+            root = node
+            node = getattr(node, "parent", None)
+        if node is None and root is not None:
+            root.check_budget()
+
+    def check_budget(self):
+        if self.budget is not None and self.complexity > self.budget:
+            raise ValueError(f"Query complexity exceeds the budget of {self.budget}")
+
+    def invalidate(self, complexity=True):
+        """Drop the cached serialisation and complexity of this node and its ancestors, after the tree changes"""
+        node = self
+        cleared = []
+        # An ancestor can only have a cache if this node does, so stop at the first without
+        while node is not None and (
+            node._json is not None or node._json_bytes is not None or (complexity and node.complexity >= 0)
+        ):
+            node._json = None
+            node._json_bytes = None
+            cleared.append(node)
+            node = getattr(node, "parent", None)
+        if complexity and cleared:
+            # Under a budget, mark the dropped complexities so the next add() checks the total again
+            if node is None:
+                recheck = cleared[-1].budget is not None
+            else:
+                recheck = node.complexity == _RECHECK
+            for x in cleared:
+                x.complexity = _RECHECK if recheck else -1
+
+    def to_json(self, encoded=False):
+        """Serialise the query, or with encoded=True return it as UTF-8 JSON bytes
+
+        The result is cached until the tree is changed with add() or invalidate(), so must not be modified
+        """
+        if encoded:
+            return self.to_json_bytes()
+        if self._json is None:
+            if instrument.enabled:
+                with instrument.stage("to_json"):
+                    self.build_json_tree()
+            else:
+                self.build_json_tree()
+        return self._json
+
+    def build_json_tree(self):
+        # Uncached nodes children first, so that each build_json() finds its children's JSON already cached
+        for node in post_order(self, lambda x: x._json is None):
+            node._json = node.build_json()
+
+    def to_json_bytes(self):
+        """The query as UTF-8 JSON bytes, identical to json.dumps(self.to_json()), without building the dicts"""
+        if not self._json_bytes:
+            self._json_bytes = "".join(self.json_pieces()).encode("utf-8")
+        return self._json_bytes
 
-    def test_child_scope(self, what):
+    def write_json(self, fp):
+        """Write the query as JSON, as json.dump(self.to_json(), fp) would, to the text file fp"""
+        if self._json_bytes:
+            fp.write(self._json_bytes.decode("utf-8"))
+        else:
+            fp.writelines(self.json_pieces())
+
+    def json_pieces(self):
+        # The JSON serialisation as a list of strings; the stack holds nodes and the literal text between them
+        out = []
+        stack = [self]
+        while stack:
+            item = stack.pop()
+            if type(item) is str:
+                out.append(item)
+            else:
+                if item._json_bytes is None:
+                    # Only the top node caches its bytes; mark the rest so that invalidate() gets up to it
+                    item._json_bytes = _ENCODED_ABOVE
+                item.encode_json(out, stack)
+        return out
+
+    def encode_json(self, out, stack):
+        # Append this node's JSON text to out, pushing what follows it (children and closing text) onto stack
+        raise NotImplementedError()
+
+    def check_child(self, what):
+        # Can what be added here, and is its value valid in the scope it would have?
+        state = self.config.state
+        info = self.test_child_scope(what, state)
+        if info is not None:
+            what.test_my_value(info, state)
+
+    def test_child_scope(self, what, state):
         # Can I accept what as a child?
-        if self.provides_scope in what.possible_parent_scopes:
-            if isinstance(what, LuxBoolean):
+        if isinstance(what, LuxBoolean):
+            if self.provides_scope in what.possible_parent_scopes:
                 return None
-            else:
-                info = self.config.lux_config["terms"][self.provides_scope][what.field]
+        else:
+            info = state.index.get((self.provides_scope, what.field))
+            if info is not None:
                 what.set_info(info)
                 return info
-        elif not self.provides_scope:
+        if not self.provides_scope:
             # if we don't have a scope, we can't test (e.g. unanchored bool)
             return None
         else:
@@ -131,40 +591,149 @@ class LuxScope(object):
 
     def calculate_complexity(self):
         # recursively walk the query and build complexity, caching at each level
-        self.complexity = sum([x.calculate_complexity() for x in self.children])
+        # cached values are kept up to date by add(), so only new parts of the tree are walked
+        if self.complexity < 0:
+            if instrument.enabled:
+                with instrument.stage("complexity"):
+                    self.complexity_tree()
+            else:
+                self.complexity_tree()
+            self.check_budget()
         return self.complexity
 
+    def complexity_tree(self):
+        # As build_json_tree, so that each node's children are already calculated
+        for node in post_order(self, lambda x: x.complexity < 0):
+            if node.children:
+                node.complexity = node.own_complexity() + sum([x.complexity for x in node.children])
+            else:
+                node.complexity = node.own_complexity()
+
+    def own_complexity(self):
+        return 0
+
+    def scope_changed(self):
+        # Complexity can depend on the scope of the node and of its parent
+        self.complexity = -1
+        for x in self.children or ():
+            x.complexity = -1
+
+    def canonical(self):
+        """Normalised form of the query, the same for semantically identical queries however they were built"""
+        return self.canonical_tree()[0]
+
+    def canonical_key(self):
+        """canonical() serialised to a stable string"""
+        return self.canonical_tree()[1]
+
+    def canonical_tree(self, known=None):
+        # As complexity_tree: each node's build_canonical() is given its children's results, a tuple of
+        # the canonical form, its key (json.dumps with sorted keys, built up as text so no deep nesting
+        # is ever encoded) and, for booleans, the members. known caches the results by node id.
+        done = known if known is not None else {}
+        if id(self) not in done:
+            for node in post_order(self, lambda x: id(x) not in done):
+                done[id(node)] = node.build_canonical([done[id(x)] for x in node.children or ()])
+        return done[id(self)]
+
+    def build_canonical(self, kids):
+        raise NotImplementedError()
+
+    def structural_hash(self):
+        """Hash that is the same for semantically identical queries, however they were built"""
+        return hashlib.sha1(self.canonical_key().encode("utf-8")).hexdigest()
+
 
 class LuxAPI(LuxScope):
-    """Minimal API instance that downstream applications should inherit"""
+    """Minimal API instance that downstream applications should inherit
+
+    With a budget, building a query under the API raises ValueError as soon as its complexity,
+    kept up to date as nodes are added, exceeds the budget.
+    """
+
+    __slots__ = ("budget",)
+
+    def __init__(self, scope, budget=None):
+        super().__init__(scope)
+        self.budget = budget
+        if budget is not None:
+            # Known while empty, so that additions are counted as they're made
+            self.complexity = 0
 
     def add(self, what):
         # No parent scope, we're the root of the scope tree
         if self.children:
             raise ValueError("Already have a top level query")
-        info = self.test_child_scope(what)
-        if info is not None:
-            what.test_my_value(info)
+        if instrument.enabled:
+            with instrument.stage("validation"):
+                self.check_child(what)
+        else:
+            self.check_child(what)
         super().add(what)
 
-    def to_json(self):
+    def build_json(self):
         if not self.children:
             raise ValueError("No query has been defined")
         return self.children[0].to_json()
 
+    def encode_json(self, out, stack):
+        if not self.children:
+            raise ValueError("No query has been defined")
+        stack.append(self.children[0])
+
+    def build_canonical(self, kids):
+        if not kids:
+            raise ValueError("No query has been defined")
+        canon, key, _ = kids[0]
+        return (
+            {"_scope": self.provides_scope, "_query": canon},
+            f'{{"_query":{key},"_scope":{json.dumps(self.provides_scope)}}}',
+            None,
+        )
+
 
 class LuxQuery(LuxScope):
     """Abstract base class for the different parts of the LUX query language"""
 
-    def __init__(self, field, parent=None):
-        super().__init__(None)
-        self.class_name = "Query Component"
+    __slots__ = ("field", "parent", "possible_parent_scopes", "possible_provides_scopes")
+    class_name = "Query Component"
+    requires_scope = None
+
+    def __init__(self, field, parent=None, **fields):
+        self._init_fields(field, parent, **fields)
+
+    def _init_fields(self, field, parent):
+        super()._init_fields(None)
         self.field = field
         self.parent = parent
-        self.requires_scope = None
-        self.possible_parent_scopes = []
-        self.possible_provides_scopes = []
-        self.complexity = -1
+        self.possible_parent_scopes = ()
+        self.possible_provides_scopes = ()
+
+    @classmethod
+    def _restore(cls, state, field, parent, **fields):
+        """Build a node as the constructor and parent.add() would, without their checks
+
+        For trees that were validated when first built, such as those decoded by luxql.wire"""
+        node = cls.__new__(cls)
+        node._init_fields(field, parent, **fields)
+        node._restore_scopes(state)
+        if parent is not None:
+            parent.children.append(node)
+            if isinstance(parent, LuxBoolean):
+                parent.possible_parent_scopes = node.possible_parent_scopes
+        return node
+
+    def _restore_scopes(self, state):
+        # The scopes calculate_scopes and set_info would give the node
+        fi = state.fields[self.field]
+        self.possible_parent_scopes = fi.parent_scopes
+        self.possible_provides_scopes = fi.provides_scopes
+        parent_scope = self.parent.provides_scope if self.parent is not None else None
+        info = state.index.get((parent_scope, self.field)) if parent_scope else None
+        if info is not None:
+            self.provides_scope = info.relation
+        elif len(fi.provides_scopes) == 1:
+            self.provides_scope = fi.provides_scopes[0]
 
     def __and__(self, other):
         b = LuxBoolean("AND")
@@ -195,12 +764,11 @@ class LuxQuery(LuxScope):
         b.add(self)
         return b
 
-    def calculate_scopes(self):
-        self.possible_parent_scopes = self.config.inverted.get(self.field, [])
-        for s in self.possible_parent_scopes:
-            prov = self.config.lux_config["terms"][s][self.field]["relation"]
-            if prov not in self.possible_provides_scopes:
-                self.possible_provides_scopes.append(prov)
+    def calculate_scopes(self, state):
+        fi = state.fields.get(self.field)
+        if fi is not None:
+            self.possible_parent_scopes = fi.parent_scopes
+            self.possible_provides_scopes = fi.provides_scopes
         if len(self.possible_provides_scopes) == 1:
             self.provides_scope = self.possible_provides_scopes[0]
         elif not self.possible_provides_scopes:
@@ -215,13 +783,15 @@ class LuxQuery(LuxScope):
         if isinstance(what, LuxAPI):
             # Nope!
             raise ValueError("Cannot add an API instance into a query")
-        info = self.test_child_scope(what)
-        if info is not None:
-            what.test_my_value(info)
+        if instrument.enabled:
+            with instrument.stage("validation"):
+                self.check_child(what)
+        else:
+            self.check_child(what)
         # If above hasn't raised, then add
         super().add(what)
 
-    def test_my_value(self, info):
+    def test_my_value(self, info, state):
         pass
 
     def add_to_parent(self):
@@ -232,66 +802,122 @@ class LuxQuery(LuxScope):
         pass
 
     def set_info(self, info):
-        self.provides_scope = info["relation"]
+        if self.provides_scope != info.relation:
+            self.provides_scope = info.relation
+            self.scope_changed()
 
 
 class LuxBoolean(LuxQuery):
     """Boolean operators AND, OR and NOT"""
 
+    __slots__ = ("unsatisfiable",)
+    class_name = "Boolean"
+
     def __init__(self, field, parent=None):
         super().__init__(field, parent=parent)
-        self.class_name = "Boolean"
-        if field not in self.config.module_config["booleans"]:
-            raise ValueError(
-                f"Tried to construct unknown boolean {field}; known: {self.config.module_config['booleans']}"
-            )
-        # Booleans are currently accepted everywhere other than leaves, so parent scope doesn't need testing
-        self.possible_parent_scopes = self.config.scopes
+        self.check_field(field)
         if parent is not None:
             self.add_to_parent()
 
-    def to_json(self):
+    def _init_fields(self, field, parent):
+        super()._init_fields(field, parent)
+        # Set by luxql.optimizer when an AND's clauses contradict each other, so it can never match
+        self.unsatisfiable = False
+        # Booleans are currently accepted everywhere other than leaves, so parent scope doesn't need testing
+        self.possible_parent_scopes = self.config.scopes
+
+    def _restore_scopes(self, state):
+        # As added_to
+        self.provides_scope = self.parent.provides_scope if self.parent is not None else None
+
+    @classmethod
+    def check_field(cls, field):
+        if field not in cls.config.module_config["booleans"]:
+            raise ValueError(
+                f"Tried to construct unknown boolean {field}; known: {cls.config.module_config['booleans']}"
+            )
+
+    def build_json(self):
         if not self.children:
             raise ValueError(f"Boolean {self.field} is missing children")
         return {self.field: [x.to_json() for x in self.children]}
 
+    def encode_json(self, out, stack):
+        if not self.children:
+            raise ValueError(f"Boolean {self.field} is missing children")
+        out.append(f"{{{encode_basestring_ascii(self.field)}: [")
+        stack.append("]}")
+        for i in range(len(self.children) - 1, 0, -1):
+            stack.append(self.children[i])
+            stack.append(", ")
+        stack.append(self.children[0])
+
+    def build_canonical(self, kids):
+        # Nested AND/OR flattened, single children unwrapped, children deduplicated and sorted
+        if not kids:
+            raise ValueError(f"Boolean {self.field} is missing children")
+        found = {}
+        for kid in kids:
+            canon, key, members = kid
+            if self.field != "NOT" and members is not None and list(canon.keys()) == [self.field]:
+                # AND(AND(a, b), c) is AND(a, b, c)
+                for m in members:
+                    found[m[1]] = m
+            else:
+                found[key] = kid
+        if len(found) == 1 and self.field != "NOT":
+            return next(iter(found.values()))
+        members = [found[k] for k in sorted(found)]
+        key = f'{{{encode_basestring_ascii(self.field)}:[{",".join(m[1] for m in members)}]}}'
+        return {self.field: [m[0] for m in members]}, key, members
+
     def added_to(self, parent):
-        self.provides_scope = parent.provides_scope
+        if self.provides_scope != parent.provides_scope:
+            self.provides_scope = parent.provides_scope
+            self.scope_changed()
 
     def add(self, what):
         super().add(what)
         self.possible_parent_scopes = what.possible_parent_scopes
 
-    def calculate_complexity(self):
-        down = super().calculate_complexity()
+    def own_complexity(self):
         if self.field == "OR":
-            self.complexity = 2 + down
+            return 2
         else:  # AND or NOT require more comparisons
-            self.complexity = 6 + down
-        return self.complexity
+            return 6
 
 
 class LuxLeaf(LuxQuery):
     """A Leaf node in the query, where the field + (comparitor +) term (+ options) sits"""
 
+    __slots__ = ("value", "comparitor", "options", "weight", "complete")
+    class_name = "Leaf"
+
     def __init__(self, field, parent=None, value=None, comparitor=None, options=[], weight=0, complete=False):
-        super().__init__(field, parent=parent)
+        super().__init__(
+            field,
+            parent=parent,
+            value=value,
+            comparitor=comparitor,
+            options=options,
+            weight=weight,
+            complete=complete,
+        )
+        state = self.config.state
+        self.check_modifiers(state, comparitor, options)
         # Can field exist within current scope?
-        self.class_name = "Leaf"
+        self.calculate_scopes(state)
+
+    def _init_fields(self, field, parent, value=None, comparitor=None, options=[], weight=0, complete=False):
+        super()._init_fields(field, parent)
         self.value = value
         self.comparitor = comparitor
-        if self.comparitor and self.comparitor not in self.config.possible_comparitors:
-            raise ValueError(f"{self.comparitor} is not a known comparitor")
         self.options = options
-        for o in self.options:
-            if o not in self.config.possible_options:
-                raise ValueError(f"{o} is not a known option")
         self.children = None
         self.weight = weight
         self.complete = complete
-        self.calculate_scopes()
 
-    def calculate_complexity(self):
+    def own_complexity(self):
         c = 1
         if self.weight:
             c += 1
@@ -306,77 +932,93 @@ class LuxLeaf(LuxQuery):
         # Give a slight bump on anywhere (compared to name or etc)
         if self.field == "anywhere":
             c += 1
+        return c
 
-        self.complexity = c
-        return self.complexity
+    def calculate_scopes(self, state):
+        super().calculate_scopes(state)
+        self.check_scopes(state.fields[self.field], self.field)
+        if self.value is not None:
+            for s in self.possible_provides_scopes:
+                self.test_my_value(state.relation_info[s], state)
+
+    def test_my_value(self, info, state):
+        self.check_value(state, info, self.field, self.value, self.comparitor, self.options)
+
+    @classmethod
+    def check_modifiers(cls, state, comparitor, options):
+        """Test that a leaf's comparitor and options are known at all, whatever its field"""
+        if comparitor and comparitor not in cls.config.possible_comparitors:
+            raise ValueError(f"{comparitor} is not a known comparitor")
+        for o in options:
+            if o not in state.possible_options:
+                raise ValueError(f"{o} is not a known option")
 
-    def calculate_scopes(self):
-        super().calculate_scopes()
-        for s in self.possible_provides_scopes:
-            if s not in self.config.module_config["leaf_scopes"]:
-                raise ValueError(f"Unknown leaf scope '{s}' in {self.field}")
-            if self.value is not None:
-                self.test_my_value({"relation": s})
+    @classmethod
+    def check_scopes(cls, fi, field):
+        """Test that every scope field provides, from its FieldInfo fi, is a leaf scope"""
+        if fi.bad_leaf_scope is not None:
+            raise ValueError(f"Unknown leaf scope '{fi.bad_leaf_scope}' in {field}")
 
-    def test_my_value(self, info):
-        if info["relation"] in self.config.scopes:
+    @classmethod
+    def check_value(cls, state, info, field, value, comparitor=None, options=()):
+        """Test a leaf's value, comparitor and options against the compiled TermInfo for its field, from state"""
+        if not info.is_leaf:
             # This isn't a leaf
-            raise ValueError(f"Cannot create a {self.class_name} called {self.field} as it is a Relationship")
-        elif info["relation"] == "text":
+            raise ValueError(f"Cannot create a {cls.class_name} called {field} as it is a Relationship")
+        elif info.relation == "text":
             # value must be a string
-            if type(self.value) is not str:
-                raise ValueError(f"Text values must be strings; '{self.field}' received {self.value})")
-            if "allowedOptionsName" in info:
-                optName = info["allowedOptionsName"]
-                okay_opts = self.config.lux_config["options"][optName]["allowed"]
-                for o in self.options:
-                    if o not in okay_opts:
+            if type(value) is not str:
+                raise ValueError(f"Text values must be strings; '{field}' received {value})")
+            if info.options is not None:
+                for o in options:
+                    if o not in info.options:
+                        okay_opts = state.lux_config["options"][info.options_name]["allowed"]
                         raise ValueError(f"Unknown option specified: {o}\nAllowed: {', '.join(okay_opts)}")
-        elif self.options:
+        elif options:
             raise ValueError("Only 'text' leaf nodes can have options")
-        elif info["relation"] == "date":
+        elif info.relation == "date":
             # test value is a datestring
-            if not self.config.valid_date_re.match(self.value):
+            if not state.valid_date_re.match(value):
                 raise ValueError(
                     "Dates require a specific format: 'YYYY-MM-DDThh:mm:ss.000Z' or '-YYYYYY-MM-DDThh:mm:ss.000Z'"
                 )
             # Test there's a comparitor
-            if not self.comparitor:
+            if not comparitor:
                 raise ValueError("Dates require a comparitor")
-            elif self.comparitor not in self.config.module_config["comparitors"]:
-                raise ValueError(f"{self.comparitor} is not a valid comparitor")
-        elif info["relation"] == "float":
+            elif comparitor not in info.comparitors:
+                raise ValueError(f"{comparitor} is not a valid comparitor")
+        elif info.relation == "float":
             # test value is a number
             try:
-                float(self.value)
+                float(value)
             except ValueError:
                 raise ValueError("Numbers must be expressed using only numbers and .")
-            if not self.comparitor:
+            if not comparitor:
                 raise ValueError("Numbers require a comparitor")
-            elif self.comparitor not in self.config.module_config["comparitors"]:
-                raise ValueError(f"{self.comparitor} is not a valid comparitor")
-        elif info["relation"] == "boolean":
+            elif comparitor not in info.comparitors:
+                raise ValueError(f"{comparitor} is not a valid comparitor")
+        elif info.relation == "boolean":
             # test is bool
-            if self.value not in ["0", "1", True, False]:
+            if value not in ["0", "1", True, False]:
                 raise ValueError("Booleans must be expressed as either '1' or '0' or a native boolean")
         else:
             # broken??
-            raise ValueError(f"Unknown scope: {info['relation']}")
+            raise ValueError(f"Unknown scope: {info.relation}")
 
     def add(self, what):
         raise ValueError("You cannot add further query components to a Leaf")
 
-    def to_json(self):
+    def json_value(self):
         if self.value is None:
             raise ValueError(f"Leaf node '{self.field}' does not have a value set")
         elif isinstance(self.value, bool):
-            value = "1" if self.value else "0"
+            return "1" if self.value else "0"
         elif not isinstance(self.value, str):
-            value = str(self.value)
-        else:
-            value = self.value
+            return str(self.value)
+        return self.value
 
-        js = {self.field: value}
+    def build_json(self):
+        js = {self.field: self.json_value()}
         if self.comparitor:
             js["_comp"] = self.comparitor
         if self.options:
@@ -387,39 +1029,89 @@ class LuxLeaf(LuxQuery):
             js["_complete"] = True if self.complete else False
         return js
 
+    def encode_json(self, out, stack):
+        parts = [f"{{{encode_basestring_ascii(self.field)}: {encode_basestring_ascii(self.json_value())}"]
+        if self.comparitor:
+            parts.append(f', "_comp": {_encode_value(self.comparitor)}')
+        if self.options:
+            parts.append(f', "_options": [{", ".join(_encode_value(o) for o in self.options)}]')
+        if self.weight:
+            parts.append(f', "_weight": {json.dumps(self.weight)}')
+        if self.complete:
+            parts.append(', "_complete": true')
+        parts.append("}")
+        out.append("".join(parts))
+
+    def build_canonical(self, kids):
+        js = {self.field: self.json_value()}
+        if self.comparitor:
+            js["_comp"] = self.comparitor
+        if self.options:
+            js["_options"] = sorted(set(self.options))
+        if self.weight:
+            js["_weight"] = self.weight
+        if self.complete:
+            js["_complete"] = True
+        return js, json.dumps(js, sort_keys=True, separators=(",", ":")), None
+
 
 class LuxRelationship(LuxQuery):
     """A relationship node in the query"""
 
+    __slots__ = ()
+    class_name = "Relationship"
+
     def __init__(self, field, parent=None):
         super().__init__(field, parent=parent)
-        self.class_name = "Relationship"
-        self.calculate_scopes()
+        self.calculate_scopes(self.config.state)
+
+    def calculate_scopes(self, state):
+        super().calculate_scopes(state)
+        self.check_scopes(state.fields[self.field], self.field)
+
+    @classmethod
+    def check_scopes(cls, fi, field):
+        """Test that every scope field provides, from its FieldInfo fi, is a search scope"""
+        if fi.bad_rel_scope is not None:
+            raise ValueError(f"Unknown relationship scope '{fi.bad_rel_scope}' in {field}")
 
-    def calculate_scopes(self):
-        super().calculate_scopes()
-        for s in self.possible_provides_scopes:
-            if s not in self.config.scopes:
-                raise ValueError(f"Unknown relationship scope '{s}' in {self.field}")
+    def test_my_value(self, info, state):
+        self.check_value(state, info, self.field)
 
-    def test_my_value(self, info):
-        if info["relation"] not in self.config.scopes:
-            raise ValueError(f"Cannot create a {self.class_name} called {self.field} as it is a Leaf")
+    @classmethod
+    def check_value(cls, state, info, field):
+        if info.is_leaf:
+            raise ValueError(f"Cannot create a {cls.class_name} called {field} as it is a Leaf")
 
     def add(self, what):
         if self.children:
             raise ValueError("Relationship already has a child")
         super().add(what)
 
-    def to_json(self):
+    def build_json(self):
         if not self.children:
             raise ValueError(f"Relationship {self.field} is missing children")
         return {self.field: self.children[0].to_json()}
 
-    def calculate_complexity(self):
-        down = super().calculate_complexity()
+    def encode_json(self, out, stack):
+        if not self.children:
+            raise ValueError(f"Relationship {self.field} is missing children")
+        out.append(f"{{{encode_basestring_ascii(self.field)}: ")
+        stack.append("}")
+        stack.append(self.children[0])
+
+    def build_canonical(self, kids):
+        if not kids:
+            raise ValueError(f"Relationship {self.field} is missing children")
+        canon, key, _ = kids[0]
+        return {self.field: canon}, f"{{{encode_basestring_ascii(self.field)}:{key}}}", None
+
+    def added_to(self, parent):
+        # Depends on the parent's scope
+        self.complexity = -1
+
+    def own_complexity(self):
+        parent_scope = self.parent.provides_scope if self.parent is not None else None
         a = self.config.lux_stats["estimates"]["searchScopes"].get(self.provides_scope, 1)
-        b = self.config.lux_stats["estimates"]["searchScopes"].get(self.parent.provides_scope, 1)
-        c = len(str(a * b))
-        self.complexity = c + down
-        return self.complexity
+        b = self.config.lux_stats["estimates"]["searchScopes"].get(parent_scope, 1)
+        return len(str(a * b))
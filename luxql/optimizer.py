@@ -0,0 +1,214 @@
+"""Rewrite built query trees into equivalent, cheaper ones"""
+
+import re
+
+from .luxql import LuxBoolean, LuxLeaf, post_order
+
+# Comparitors that bound a range from below and above
+_lower = (">", ">=")
+_upper = ("<", "<=")
+# YYYY, YYYY-MM, YYYY-MM-DD or YYYY-MM-DDThh:mm:ss, with the year optionally -YYYYYY as in the config's
+# valid_date_re, and an optional fraction of a second and Z
+_date_re = re.compile(
+    r"((?:-[0-9]{2})?[0-9]{4})"
+    r"(?:-([0-1][0-9])(?:-([0-3][0-9])(?:T([0-2][0-9]):([0-5][0-9]):([0-5][0-9])(?:\.[0-9]+)?Z?)?)?)?"
+)
+
+
+def optimize(api):
+    """Optimize the query under api in place, and return api
+
+    - AND(AND(a, b), c) becomes AND(a, b, c), and likewise for OR
+    - AND and OR with a single child are replaced by the child
+    - Duplicate siblings (by structural equality) are removed
+    - Date and number comparisons on the same field under an AND are merged into the tightest
+      range, and an AND whose comparisons can't all hold is marked unsatisfiable
+    - AND children are ordered by ascending complexity, so cheaper clauses come first
+    """
+    if not api.children:
+        raise ValueError("No query has been defined")
+    top = optimize_node(api.children[0])
+    top.parent = api
+    api.children[0] = top
+    api.invalidate()
+    return api
+
+
+def optimize_node(node):
+    """Optimize the subtree at node, returning the node that should replace it"""
+    # Children are optimized before their parents. The canonical forms found to spot duplicates are
+    # kept by node id, as optimized subtrees don't change again.
+    done = {}
+    known = {}
+    for x in post_order(node):
+        done[id(x)] = optimize_one(x, [done.pop(id(c)) for c in x.children or ()], known)
+    return done[id(node)]
+
+
+def optimize_one(node, kids, known):
+    # node, whose children have been optimized into kids
+    if isinstance(node, LuxLeaf):
+        return node
+
+    if isinstance(node, LuxBoolean):
+        flat = []
+        for x in kids:
+            if node.field != "NOT" and isinstance(x, LuxBoolean) and x.field == node.field:
+                flat.extend(x.children)
+            else:
+                flat.append(x)
+        seen = set()
+        kids = []
+        for x in flat:
+            key = x.canonical_tree(known)[1]
+            if key not in seen:
+                seen.add(key)
+                kids.append(x)
+        if node.field == "AND":
+            kids = coalesce_ranges(node, kids)
+        if len(kids) == 1 and node.field != "NOT" and not node.unsatisfiable:
+            return kids[0]
+
+    for x in kids:
+        x.parent = node
+    if isinstance(node, LuxBoolean) and node.field == "AND":
+        # complexity of relationships depends on their parent's scope, so sort after reparenting
+        kids.sort(key=lambda x: x.calculate_complexity())
+    node.children = kids
+    node.invalidate()
+    return node
+
+
+def range_key(leaf):
+    """(start, end) of the values a date or float leaf's value could mean, or None if it can't be parsed
+
+    A float is a single point. A date is the period it names: a year, month or day runs from its first
+    to its last instant, and only a date with a time is a single point.
+    """
+    if leaf.provides_scope == "float":
+        try:
+            value = float(leaf.value)
+        except (TypeError, ValueError):
+            return None
+        return value, value
+    m = _date_re.fullmatch(leaf.value) if isinstance(leaf.value, str) else None
+    if m is None:
+        return None
+    year, month, day, *hms = m.groups()
+    year = int(year)
+    if hms[0] is not None:
+        point = (year, int(month), int(day)) + tuple(int(x) for x in hms)
+        return point, point
+    elif day is not None:
+        return (year, int(month), int(day), 0, 0, 0), (year, int(month), int(day), 23, 59, 59)
+    elif month is not None:
+        # No month has more than 31 days, so this is after every instant in it
+        return (year, int(month), 1, 0, 0, 0), (year, int(month), 31, 23, 59, 59)
+    return (year, 1, 1, 0, 0, 0), (year, 12, 31, 23, 59, 59)
+
+
+def _thresholds(a, b):
+    # Where to compare a, a lower bound, with b, an upper bound, so that they only conflict however a
+    # partial date is read: the same value means the same thing, otherwise take the loosest readings
+    if a[0] == b[0]:
+        return a[0][0], a[0][0]
+    return a[0][0], b[0][1]
+
+
+def _conflict(a, b):
+    # Can no value be at or above the lower bound a and at or below the upper bound b?
+    # Bounds are (range_key, comparitor), with equality taken as both ">=" and "<="
+    lo, hi = _thresholds(a, b)
+    return lo > hi or (lo == hi and (a[1] == ">" or b[1] == "<"))
+
+
+def _implies_lower(a, b):
+    # Is the lower bound b redundant given the lower bound a, however partial dates are read?
+    ta, tb = (a[0][0], a[0][0]) if a[0] == b[0] else (a[0][0], b[0][1])
+    return ta > tb or (ta == tb and (a[1] == ">" or b[1] == ">="))
+
+
+def _implies_upper(a, b):
+    ta, tb = (a[0][0], a[0][0]) if a[0] == b[0] else (a[0][1], b[0][0])
+    return ta < tb or (ta == tb and (a[1] == "<" or b[1] == "<="))
+
+
+def coalesce_ranges(node, kids):
+    """Replace the date and float comparisons on each field among the children of the AND node with the
+    tightest bounds, marking node unsatisfiable if they contradict each other
+
+    Partial dates are periods rather than points, so clauses are only merged, and only declared
+    contradictory, when that holds whichever instants of the periods the comparisons are read as.
+    """
+    groups = {}
+    for x in kids:
+        if (
+            isinstance(x, LuxLeaf)
+            and x.provides_scope in ("date", "float")
+            and x.comparitor
+            and not x.weight
+            and not x.complete
+        ):
+            key = range_key(x)
+            if key is not None:
+                groups.setdefault(x.field, []).append((key, x))
+
+    drop = set()
+    for leaves in groups.values():
+        if len(leaves) < 2:
+            continue
+        lower = [(key, x.comparitor, x) for key, x in leaves if x.comparitor in _lower]
+        upper = [(key, x.comparitor, x) for key, x in leaves if x.comparitor in _upper]
+        equal = [(key, x.comparitor, x) for key, x in leaves if x.comparitor == "=="]
+        not_equal = [(key, x.comparitor, x) for key, x in leaves if x.comparitor == "!="]
+
+        # Equalities are both lower and upper bounds
+        as_lower = lower + [(key, ">=", x) for key, _, x in equal]
+        as_upper = upper + [(key, "<=", x) for key, _, x in equal]
+        if any(_conflict(a, b) for a in as_lower for b in as_upper if a[2] is not b[2]):
+            node.unsatisfiable = True
+        if any(e[0] == n[0] for e in equal for n in not_equal):
+            node.unsatisfiable = True
+
+        # Drop bounds implied by another clause; of two that imply each other, keep the first
+        for bounds, implies in ((lower, _implies_lower), (upper, _implies_upper)):
+            stronger = as_lower if implies is _implies_lower else as_upper
+            for i, b in enumerate(bounds):
+                for j, a in enumerate(stronger):
+                    if a[2] is not b[2] and implies(a, b):
+                        if a[2].comparitor == "==" or not implies(b, a) or j < i:
+                            drop.add(id(b[2]))
+                            break
+        # Equalities naming the same period as an earlier one
+        for i, e in enumerate(equal):
+            if any(f[0] == e[0] for f in equal[:i]):
+                drop.add(id(e[2]))
+
+    if node.unsatisfiable:
+        # Leave the clauses as they were written, so the contradiction can be reported
+        return kids
+    return [x for x in kids if id(x) not in drop]
+
+
+def is_unsatisfiable(node):
+    """Whether the query at node can never match, going by the AND nodes optimize() marked"""
+    # Decided for children before their parents
+    done = {}
+    for x in post_order(node):
+        kids = [done.pop(id(c)) for c in x.children or ()]
+        if isinstance(x, LuxBoolean):
+            if x.unsatisfiable:
+                result = True
+            elif x.field == "AND":
+                result = any(kids)
+            elif x.field == "OR":
+                result = all(kids)
+            else:
+                result = False
+        elif isinstance(x, LuxLeaf):
+            result = False
+        else:
+            # A relationship, or the API
+            result = bool(kids) and kids[0]
+        done[id(x)] = result
+    return done[id(node)]
@@ -0,0 +1,48 @@
+
+# parsetab.py
+# This file is automatically generated. Do not edit.
+# pylint: disable=W,C,R
+_tabversion = '3.10'
+
+_lr_method = 'LALR'
+
+_lr_signature = 'leftORleftANDrightNOTAND ARROW COLON COMPARATOR LPAREN NOT OR QUOTED_STRING RPAREN WORDquery : expressionexpression : expression AND expression\n    | expression OR expressionexpression : NOT expressionexpression : LPAREN expression RPARENexpression : term_listterm_list : termterm_list : term_list termterm : WORDterm : QUOTED_STRINGterm : WORD COLON WORDterm : WORD COLON QUOTED_STRINGterm : field_chain COLON WORDterm : field_chain COLON QUOTED_STRINGterm : field_chain COMPARATOR WORDterm : field_chain COMPARATOR QUOTED_STRINGfield_chain : WORDfield_chain : field_chain ARROW WORD'
+    
+_lr_action_items = {'NOT':([0,3,4,10,11,],[3,3,3,3,3,]),'LPAREN':([0,3,4,10,11,],[4,4,4,4,4,]),'WORD':([0,3,4,5,6,7,8,10,11,14,15,16,17,18,22,23,24,25,26,27,],[7,7,7,7,-7,-9,-10,7,7,-8,22,24,26,28,-11,-12,-13,-14,-15,-16,]),'QUOTED_STRING':([0,3,4,5,6,7,8,10,11,14,15,16,17,22,23,24,25,26,27,],[8,8,8,8,-7,-9,-10,8,8,-8,23,25,27,-11,-12,-13,-14,-15,-16,]),'$end':([1,2,5,6,7,8,12,14,19,20,21,22,23,24,25,26,27,],[0,-1,-6,-7,-9,-10,-4,-8,-2,-3,-5,-11,-12,-13,-14,-15,-16,]),'AND':([2,5,6,7,8,12,13,14,19,20,21,22,23,24,25,26,27,],[10,-6,-7,-9,-10,-4,10,-8,-2,10,-5,-11,-12,-13,-14,-15,-16,]),'OR':([2,5,6,7,8,12,13,14,19,20,21,22,23,24,25,26,27,],[11,-6,-7,-9,-10,-4,11,-8,-2,-3,-5,-11,-12,-13,-14,-15,-16,]),'RPAREN':([5,6,7,8,12,13,14,19,20,21,22,23,24,25,26,27,],[-6,-7,-9,-10,-4,21,-8,-2,-3,-5,-11,-12,-13,-14,-15,-16,]),'COLON':([7,9,28,],[15,16,-18,]),'COMPARATOR':([7,9,28,],[-17,17,-18,]),'ARROW':([7,9,28,],[-17,18,-18,]),}
+
+_lr_action = {}
+for _k, _v in _lr_action_items.items():
+   for _x,_y in zip(_v[0],_v[1]):
+      if not _x in _lr_action:  _lr_action[_x] = {}
+      _lr_action[_x][_k] = _y
+del _lr_action_items
+
+_lr_goto_items = {'query':([0,],[1,]),'expression':([0,3,4,10,11,],[2,12,13,19,20,]),'term_list':([0,3,4,10,11,],[5,5,5,5,5,]),'term':([0,3,4,5,10,11,],[6,6,6,14,6,6,]),'field_chain':([0,3,4,5,10,11,],[9,9,9,9,9,9,]),}
+
+_lr_goto = {}
+for _k, _v in _lr_goto_items.items():
+   for _x, _y in zip(_v[0], _v[1]):
+       if not _x in _lr_goto: _lr_goto[_x] = {}
+       _lr_goto[_x][_k] = _y
+del _lr_goto_items
+_lr_productions = [
+  ("S' -> query","S'",1,None,None,None),
+  ('query -> expression','query',1,'p_query','string_parser.py',265),
+  ('expression -> expression AND expression','expression',3,'p_expression_binop','string_parser.py',270),
+  ('expression -> expression OR expression','expression',3,'p_expression_binop','string_parser.py',271),
+  ('expression -> NOT expression','expression',2,'p_expression_not','string_parser.py',276),
+  ('expression -> LPAREN expression RPAREN','expression',3,'p_expression_group','string_parser.py',281),
+  ('expression -> term_list','expression',1,'p_expression_term_list','string_parser.py',286),
+  ('term_list -> term','term_list',1,'p_term_list_single','string_parser.py',291),
+  ('term_list -> term_list term','term_list',2,'p_term_list_multiple','string_parser.py',299),
+  ('term -> WORD','term',1,'p_term_word','string_parser.py',308),
+  ('term -> QUOTED_STRING','term',1,'p_term_quoted','string_parser.py',313),
+  ('term -> WORD COLON WORD','term',3,'p_term_field_word','string_parser.py',318),
+  ('term -> WORD COLON QUOTED_STRING','term',3,'p_term_field_quoted','string_parser.py',323),
+  ('term -> field_chain COLON WORD','term',3,'p_term_field_chain_word','string_parser.py',328),
+  ('term -> field_chain COLON QUOTED_STRING','term',3,'p_term_field_chain_quoted','string_parser.py',333),
+  ('term -> field_chain COMPARATOR WORD','term',3,'p_term_field_comp_word','string_parser.py',338),
+  ('term -> field_chain COMPARATOR QUOTED_STRING','term',3,'p_term_field_comp_quoted','string_parser.py',343),
+  ('field_chain -> WORD','field_chain',1,'p_field_chain_single','string_parser.py',348),
+  ('field_chain -> field_chain ARROW WORD','field_chain',3,'p_field_chain_multiple','string_parser.py',353),
+]
@@ -0,0 +1,171 @@
+"""Prepared queries: a template validated once, then bound to new leaf values cheaply
+
+Placeholders are written $1, $2, ... in place of leaf values, either in a QueryParser string:
+
+    creator->name:$1 AND producedDate>=$2
+
+or as the whole value of a leaf in JSON, {"name": "$1"}. In a query string a placeholder is always
+a whole value, $1 or "$1"; a $ inside other quoted text is just part of the text. The template is
+built and validated once; bind() then only runs LuxLeaf.check_value on the new values and splices
+them into the pre-encoded JSON.
+"""
+
+import re
+from json.encoder import encode_basestring_ascii
+
+from .luxql import LuxLeaf, post_order
+
+# Quoted strings are matched first, so that only whole values are taken as placeholders
+_template_re = re.compile(r'"[^"]*"|(?<![\w.])\$(\d+)(?![\w.])|\$')
+_value_placeholder_re = re.compile(r"^\$(\d+)$")
+# Placeholders are replaced by this word before parsing, as $ isn't part of the query string syntax
+_param_word = "luxqlparam{}x"
+_param_word_re = re.compile(r"^luxqlparam(\d+)x$")
+# Leaf values in the encoded template are replaced by these, so that they can be found again
+_marker = "\x00{}\x00"
+_marker_re = re.compile(rb'"\\u0000(\d+)\\u0000"')
+
+# Stand-in values that pass the value checks of each type of leaf, tried in order
+_stand_ins = ("1", "2000")
+
+
+def stand_in(config, field, comparitor=None, options=()):
+    """A value that is valid for field wherever it occurs, used to build a template"""
+    state = config.state
+    fi = state.fields.get(field)
+    if fi is None:
+        return _stand_ins[0]
+    for value in _stand_ins:
+        try:
+            for s in fi.provides_scopes:
+                LuxLeaf.check_value(state, state.relation_info[s], field, value, comparitor, options)
+        except (ValueError, TypeError):
+            continue
+        return value
+    # Nothing fits, so building the template will report what is wrong
+    return _stand_ins[0]
+
+
+def leaves(node):
+    """The leaves under node, in the order they were added"""
+    return [x for x in post_order(node) if isinstance(x, LuxLeaf)]
+
+
+class PreparedQuery(object):
+    """A query template built from top (the top node of the validated tree), whose leaves at the
+    positions in params (a dict of leaf index to placeholder number) take bound values"""
+
+    def __init__(self, top, params):
+        check_params(params)
+        self.scope = top.parent.provides_scope if top.parent is not None else None
+        self.template = top
+        all_leaves = leaves(top)
+        self.nparams = max(params.values()) if params else 0
+        # Values are checked against the config the template was validated with
+        self.state = top.config.state
+        self.slots = []
+        for idx, num in params.items():
+            leaf = all_leaves[idx]
+            # The checks the leaf had when built: in the scope it was added to, and in every scope it could provide
+            infos = [self.state.relation_info[s] for s in leaf.possible_provides_scopes]
+            if leaf.parent is not None and leaf.parent.provides_scope:
+                infos.append(self.state.index[(leaf.parent.provides_scope, leaf.field)])
+            self.slots.append((num, leaf.field, leaf.comparitor, tuple(leaf.options or ()), infos))
+            leaf.value = _marker.format(num)
+        top.invalidate()
+
+        # The encoded query, split around the placeholder values: text, number, text, number, ..., text
+        parts = _marker_re.split(top.to_json_bytes())
+        self.texts = [p.decode("utf-8") for p in parts[0::2]]
+        self.numbers = [int(n) for n in parts[1::2]]
+
+    def check(self, values):
+        """Run the leaf value checks on values, as building the query with them would"""
+        if len(values) != self.nparams:
+            raise ValueError(f"Expected {self.nparams} values, received {len(values)}")
+        for num, field, comparitor, options, infos in self.slots:
+            value = values[num - 1]
+            if value is None:
+                raise ValueError(f"Leaf node '{field}' does not have a value set")
+            for info in infos:
+                LuxLeaf.check_value(self.state, info, field, value, comparitor, options)
+
+    def bind(self, *values, encoded=False):
+        """The JSON for the template with $1, $2, ... replaced by values, as a string or UTF-8 bytes"""
+        self.check(values)
+        encoded_values = [encode_basestring_ascii(json_value(v)) for v in values]
+        out = [self.texts[0]]
+        for num, text in zip(self.numbers, self.texts[1:]):
+            out.append(encoded_values[num - 1])
+            out.append(text)
+        js = "".join(out)
+        return js.encode("utf-8") if encoded else js
+
+    def complexity(self):
+        """The complexity of the query, which doesn't depend on the bound values"""
+        return self.template.calculate_complexity()
+
+
+def json_value(value):
+    # As LuxLeaf.json_value
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    elif not isinstance(value, str):
+        return str(value)
+    return value
+
+
+def prepare_json(config, template):
+    """Prepare a JSON template, returning a copy with stand-in values and the placeholder positions"""
+    params = {}
+    idx = 0
+    top = {}
+    stack = [(template, top)]
+    while stack:
+        query, copy = stack.pop()
+        if not isinstance(query, dict):
+            raise ValueError("Query is not a dictionary")
+        copy.update(query)
+        for k, v in query.items():
+            if k[0] != "_":
+                if type(v) is list:
+                    copy[k] = [{} for _ in v]
+                    stack.extend(reversed(list(zip(v, copy[k]))))
+                elif type(v) is dict:
+                    copy[k] = {}
+                    stack.append((v, copy[k]))
+                else:
+                    m = _value_placeholder_re.match(v) if type(v) is str else None
+                    if m is not None:
+                        params[idx] = int(m.group(1))
+                        copy[k] = stand_in(config, k, query.get("_comp"), query.get("_options", ()))
+                    idx += 1
+                break
+    return top, params
+
+
+def param_words(template):
+    """template with its $n placeholders replaced by words the QueryParser syntax accepts"""
+
+    def replace(m):
+        text = m.group()
+        if text[0] == '"':
+            quoted = _value_placeholder_re.match(text[1:-1])
+            return _param_word.format(quoted.group(1)) if quoted is not None else text
+        elif m.group(1) is None:
+            raise ValueError(f"A placeholder must be a whole value, $ and a number, at position {m.start()}")
+        return _param_word.format(m.group(1))
+
+    return _template_re.sub(replace, template)
+
+
+def param_number(value):
+    """The placeholder number of a value from a template passed through param_words, or None"""
+    m = _param_word_re.match(value)
+    return int(m.group(1)) if m is not None else None
+
+
+def check_params(params):
+    numbers = set(params.values())
+    if numbers and numbers != set(range(1, max(numbers) + 1)):
+        raise ValueError(f"Placeholders must be numbered from $1 without gaps; found {sorted(numbers)}")
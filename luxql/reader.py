@@ -1,12 +1,26 @@
 from .luxql import LuxAPI, LuxBoolean, LuxLeaf, LuxRelationship
+from .prepared import PreparedQuery, prepare_json
 
 
 class JsonReader:
     def __init__(self, config):
         self.config = config
 
-    def read(self, query, scope):
-        """Parse query in JSON into luxql objects"""
+    def read(self, query, scope, budget=None):
+        """Parse query in JSON into luxql objects, giving up as soon as its complexity exceeds budget"""
+        self.check_top(query, scope)
+        api = LuxAPI(scope, budget)
+        return self.read_query(query, api)
+
+    def prepare(self, template, scope):
+        """Build and validate template, with "$1", "$2", ... as leaf values, once
+
+        Returns a PreparedQuery whose bind() gives the JSON for the query with the values filled in."""
+        self.check_top(template, scope)
+        query, params = prepare_json(self.config, template)
+        return PreparedQuery(self.read(query, scope), params)
+
+    def check_top(self, query, scope):
         if not query:
             raise ValueError("Query is empty")
         if not isinstance(query, dict):
@@ -16,38 +30,99 @@ class JsonReader:
         if scope not in self.config.scopes:
             raise ValueError(f"Unknown query scope '{scope}'")
 
-        api = LuxAPI(scope)
-        return self.read_query(query, api)
+    def validate(self, query, scope):
+        """Check query against the config without building luxql objects
+
+        Applies the same rules as read(), returning (True, None) or (False, error message)"""
+        try:
+            self.check_top(query, scope)
+            self.validate_query(query, scope, self.config.state)
+        except (ValueError, TypeError) as e:
+            return False, str(e)
+        return True, None
+
+    def validate_query(self, query, scope, state):
+        """Walk query as read_query would, checking each node against the scope it would be added to"""
+        stack = [(query, scope)]
+        while stack:
+            query, scope = stack.pop()
+            stack.extend(reversed(self.validate_node(query, scope, state)))
+
+    def validate_node(self, query, scope, state):
+        # Check the top node of query, returning the (sub-query, scope) pairs still to check
+        if not isinstance(query, dict):
+            raise ValueError("Query is not a dictionary")
+        for k, v in query.items():
+            if k[0] != "_":
+                if type(v) is list:
+                    LuxBoolean.check_field(k)
+                    # Booleans are accepted in any scope and pass it through to their children
+                    return [(sub, scope) for sub in v]
+                elif type(v) is dict:
+                    fi = self.validate_field(state, LuxRelationship, k, scope)
+                    LuxRelationship.check_scopes(fi, k)
+                    return [(v, state.index[(scope, k)].relation)]
+                elif type(v) in [str, int, float, bool]:
+                    cmpr = query.get("_comp", None)
+                    opts = query.get("_options", [])
+                    LuxLeaf.check_modifiers(state, cmpr, opts)
+                    fi = self.validate_field(state, LuxLeaf, k, scope, v, cmpr, opts)
+                    LuxLeaf.check_scopes(fi, k)
+                    if len(fi.provides_scopes) > 1:
+                        for s in fi.provides_scopes:
+                            LuxLeaf.check_value(state, state.relation_info[s], k, v, cmpr, opts)
+                    return []
+        # If we reach here, the query is invalid
+        raise ValueError("Invalid query")
+
+    def validate_field(self, state, cls, k, scope, *value):
+        # The checks LuxQuery.calculate_scopes and the parent's add() make for a new node
+        fi = state.fields.get(k)
+        if fi is None:
+            raise ValueError(f"No possible scope for {cls.class_name} component '{k}'")
+        info = state.index.get((scope, k))
+        if info is None:
+            raise ValueError(f"Cannot add a new {cls.class_name} of {k} to a scope of {scope}")
+        cls.check_value(state, info, k, *value)
+        return fi
 
     def read_query(self, query, parent):
-        """What sort of node are we?"""
+        """Build query into parent, returning its top node"""
+        # An explicit stack rather than recursion, so that queries of any depth can be read
+        top, subs = self.read_node(query, parent)
+        stack = subs[::-1]
+        while stack:
+            query, parent = stack.pop()
+            _, subs = self.read_node(query, parent)
+            stack.extend(reversed(subs))
+        return top
+
+    def read_node(self, query, parent):
+        """What sort of node are we? Returns the node, and the (sub-query, node) pairs still to read"""
         for k, v in query.items():
             if k[0] != "_":
                 # This is the main function
                 if type(v) is list:
                     # we're a boolean
-                    return self.make_boolean(k, query, parent)
+                    bl = self.make_boolean(k, query, parent)
+                    return bl, [(sub, bl) for sub in v]
                 elif type(v) is dict:
                     # we're a relationship
-                    return self.make_relationship(k, query, parent)
+                    rel = self.make_relationship(k, query, parent)
+                    return rel, [(v, rel)]
                 elif type(v) in [str, int, float, bool]:
                     # we're a leaf
-                    return self.make_leaf(k, query, parent)
+                    return self.make_leaf(k, query, parent), []
         # If we reach here, the query is invalid
         raise ValueError("Invalid query")
 
     def make_boolean(self, k, query, parent):
-        # we're a boolean
-        bl = LuxBoolean(k, parent=parent)
-        for v in query[k]:
-            self.read_query(v, bl)
-        return bl
+        # we're a boolean; its children are read by read_query
+        return LuxBoolean(k, parent=parent)
 
     def make_relationship(self, k, query, parent):
-        # we're a relationship
-        rel = LuxRelationship(k, parent=parent)
-        self.read_query(query[k], rel)
-        return rel
+        # we're a relationship; its child is read by read_query
+        return LuxRelationship(k, parent=parent)
 
     def make_leaf(self, k, query, parent):
         # we're a leaf
@@ -0,0 +1,53 @@
+"""Keep a LuxConfig up to date from the LUX API in the background"""
+
+import threading
+import time
+
+
+class ConfigRefresher(object):
+    """Calls config.refresh() every `interval` seconds in a daemon thread
+
+    Errors are kept in `last_error` rather than stopping the refresher, and `last_success`
+    records when the server was last reached successfully.
+
+    Example:
+        refresher = ConfigRefresher(LuxAPI.config, interval=600).start()
+        ...
+        refresher.stop()
+    """
+
+    def __init__(self, config, interval=3600):
+        self.config = config
+        self.interval = interval
+        self.last_error = None
+        self.last_success = None
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self.run, name="luxql-config-refresher", daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            self.refresh_once()
+
+    def refresh_once(self):
+        """Refresh now, returning whether anything changed"""
+        try:
+            changed = self.config.refresh()
+        except Exception as e:
+            self.last_error = e
+            return False
+        self.last_error = None
+        self.last_success = time.time()
+        return changed
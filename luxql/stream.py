@@ -0,0 +1,138 @@
+"""Streaming pipeline over files of JSON queries
+
+Queries are read one at a time from NDJSON or JSON array files, built with
+JsonReader, and the results written out as NDJSON as they are produced, so
+memory use doesn't depend on the size of the file.
+
+Example:
+    with open("queries.ndjson") as fh, open("audit.ndjson", "w") as out:
+        run_pipeline(fh, out, "item", complexity=True)
+"""
+
+import json
+
+from .luxql import LuxScope
+from .reader import JsonReader
+
+_decoder = json.JSONDecoder()
+WHITESPACE = " \t\r\n"
+SEPARATORS = WHITESPACE + ","
+# An entry cut off at the end of the data read so far fails to decode within this many characters of
+# the end (e.g. in "-Infinity" or a \uXXXX escape), or as an unterminated string
+SPLIT_MARGIN = 16
+
+
+class BadQuery(ValueError):
+    """Yielded by read_queries() in place of an NDJSON line that isn't valid JSON"""
+
+    def __init__(self, lineno, error):
+        super().__init__(f"Line {lineno}: {error}")
+        self.lineno = lineno
+
+
+def read_queries(fh, chunk_size=65536):
+    """Yield queries from an open NDJSON or JSON array file, without reading it all in
+
+    An NDJSON line that can't be decoded is yielded as a BadQuery, so the rest of the file
+    is still read; a broken JSON array can't be resynchronised, so raises.
+    """
+    lineno = 1
+    first = fh.read(1)
+    while first and first in WHITESPACE:
+        if first == "\n":
+            lineno += 1
+        first = fh.read(1)
+    if not first:
+        return
+    if first != "[":
+        # NDJSON, one query per line
+        yield from _read_lines(first + fh.readline(), fh, lineno)
+    else:
+        yield from _read_array(fh, chunk_size)
+
+
+def _read_lines(line, fh, lineno):
+    while line:
+        line = line.strip()
+        if line:
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                yield BadQuery(lineno, e)
+        line = fh.readline()
+        lineno += 1
+
+
+def _read_array(fh, chunk_size):
+    # Entries are decoded in place from an offset into buf, which is only trimmed when reading more
+    buf = ""
+    pos = 0
+    eof = False
+    while True:
+        # Skip separators between entries
+        while pos < len(buf) and buf[pos] in SEPARATORS:
+            pos += 1
+        if pos < len(buf):
+            if buf[pos] == "]":
+                return
+            try:
+                query, pos = _decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError as e:
+                # Read more if the entry could just be split across chunks; otherwise it is malformed,
+                # and reading more would only load the rest of the file before failing
+                split = e.pos >= len(buf) - SPLIT_MARGIN or e.msg.startswith("Unterminated string")
+                if eof or not split:
+                    raise
+            else:
+                yield query
+                continue
+        elif eof:
+            raise ValueError("Unterminated JSON array of queries")
+        # At least as much again as the unfinished entry, so a large one is only decoded a few times
+        data = fh.read(max(chunk_size, len(buf) - pos))
+        if not data:
+            eof = True
+        buf = buf[pos:] + data
+        pos = 0
+
+
+def process_queries(queries, scope, complexity=False, serialise=True, reader=None):
+    """Build each query and yield a result dict for it
+
+    Each result has the query's `index` and `ok`, plus `error` for invalid queries (and `line`
+    for NDJSON lines that couldn't be decoded) and, for valid ones, `query` (the to_json()
+    serialisation) and `complexity` if requested.
+    """
+    if reader is None:
+        reader = JsonReader(LuxScope.config)
+    for idx, query in enumerate(queries):
+        result = {"index": idx, "ok": True}
+        try:
+            if isinstance(query, BadQuery):
+                raise query
+            node = reader.read(query, scope)
+            if complexity:
+                result["complexity"] = node.calculate_complexity()
+            if serialise:
+                result["query"] = node.to_json()
+        except Exception as e:
+            # Record and carry on; one bad line shouldn't stop an audit
+            result = {"index": idx, "ok": False, "error": str(e)}
+            if isinstance(e, BadQuery):
+                result["line"] = e.lineno
+        yield result
+
+
+def write_results(results, fh):
+    """Write results to fh as NDJSON, returning how many were written"""
+    n = 0
+    for result in results:
+        fh.write(json.dumps(result))
+        fh.write("\n")
+        n += 1
+    return n
+
+
+def run_pipeline(infile, outfile, scope, complexity=False, serialise=True):
+    """Read queries from infile, build them in scope and write the results to outfile"""
+    return write_results(process_queries(read_queries(infile), scope, complexity, serialise), outfile)
@@ -23,10 +23,19 @@ Examples:
 # This doesn't work:
 # creator->(name:Rob AND name:Sanderson)
 
+import copy
+import os
+import re
+import sys
+import threading
+
 import ply.lex as lex
 import ply.yacc as yacc
 
+from . import instrument
+from .cache import MISSING, LRUCache
 from .luxql import LuxAPI, LuxBoolean, LuxLeaf, LuxRelationship
+from .prepared import PreparedQuery, param_number, param_words, stand_in
 
 # Token definitions
 tokens = ("AND", "OR", "NOT", "LPAREN", "RPAREN", "QUOTED_STRING", "WORD", "COLON", "ARROW", "COMPARATOR")
@@ -96,17 +105,26 @@ def t_newline(t):
 
 
 def t_error(t):
-    print(f"Illegal character '{t.value[0]}'")
+    report_error(f"Illegal character '{t.value[0]}'")
     t.lexer.skip(1)
 
 
-# Build the lexer
-lexer = lex.lex()
-
-
 # AST Node classes
 class ASTNode:
-    pass
+    def to_luxql(self, parent):
+        """Build the luxql objects for this tree into parent, returning the top one"""
+        # An explicit stack rather than recursion, so that very deep trees (e.g. long chains of ANDs) can be built
+        top, pending = self.make_luxql(parent)
+        stack = pending[::-1]
+        while stack:
+            node, lux_parent = stack.pop()
+            _, pending = node.make_luxql(lux_parent)
+            stack.extend(reversed(pending))
+        return top
+
+    def make_luxql(self, parent):
+        # Build just this node, returning it and the (AST node, luxql parent) pairs still to build
+        raise NotImplementedError()
 
 
 class BinaryOp(ASTNode):
@@ -121,11 +139,9 @@ class BinaryOp(ASTNode):
     def to_json(self):
         return {self.op: [self.left.to_json(), self.right.to_json()]}
 
-    def to_luxql(self, parent):
+    def make_luxql(self, parent):
         bl = LuxBoolean(self.op, parent)
-        self.left.to_luxql(bl)
-        self.right.to_luxql(bl)
-        return bl
+        return bl, [(self.left, bl), (self.right, bl)]
 
 
 class UnaryOp(ASTNode):
@@ -139,10 +155,9 @@ class UnaryOp(ASTNode):
     def to_json(self):
         return {self.op: [self.operand.to_json()]}
 
-    def to_luxql(self, parent):
+    def make_luxql(self, parent):
         bl = LuxBoolean(self.op, parent)
-        self.operand.to_luxql(bl)
-        return bl
+        return bl, [(self.operand, bl)]
 
 
 class Term(ASTNode):
@@ -190,7 +205,7 @@ class Term(ASTNode):
                 fld["_comp"] = self.comparitor
             return fld
 
-    def to_luxql(self, parent):
+    def make_luxql(self, parent):
         if self.fields:
             # Make a chain of LuxRelationships
             top = None
@@ -202,13 +217,13 @@ class Term(ASTNode):
                 current_parent = rel
             leaf = LuxLeaf(self.fields[-1], current_parent, str(self.value), comparitor=self.comparitor)
             if top:
-                return top
+                return top, []
             else:
-                return leaf
+                return leaf, []
         else:
             # single LuxLeaf
             leaf = LuxLeaf("text", parent, str(self.value), comparitor=self.comparitor)
-            return leaf
+            return leaf, []
 
 
 class TermList(ASTNode):
@@ -230,14 +245,12 @@ class TermList(ASTNode):
     def to_json(self):
         return {"AND": [term.to_json() for term in self.terms]}
 
-    def to_luxql(self, parent):
+    def make_luxql(self, parent):
         if isinstance(parent, LuxBoolean):
             bl = parent
         else:
             bl = LuxBoolean("AND", parent=parent)
-        for term in self.terms:
-            term.to_luxql(bl)
-        return bl
+        return bl, [(term, bl) for term in self.terms]
 
 
 # Grammar rules with precedence
@@ -344,18 +357,278 @@ def p_field_chain_multiple(p):
 
 def p_error(p):
     if p:
-        print(f"Syntax error at token {p.type} ('{p.value}') at line {p.lineno}")
+        report_error(f"Syntax error at token {p.type} ('{p.value}') at line {p.lineno}")
     else:
-        print("Syntax error at EOF")
+        report_error("Syntax error at EOF")
 
 
-# Build the parser
-parser = yacc.yacc()
+def report_error(message):
+    # Printed, as the parsers recover and carry on, unless the parse in this thread is collecting them
+    errors = getattr(_local, "errors", None)
+    if errors is None:
+        print(message)
+    else:
+        errors.append(message)
+
+
+# The lexer and parser are built on first use from the tables shipped in lextab.py and parsetab.py,
+# so importing doesn't regenerate the LALR tables or write into the package directory
+_lexer = None
+_parser = None
+_build_lock = threading.Lock()
+# Lexers and parsers keep the state of the current parse on themselves, so each thread gets its own
+_local = threading.local()
+
+
+def get_lexer():
+    global _lexer
+    if _lexer is None:
+        with _build_lock:
+            if _lexer is None:
+                _lexer = lex.lex(optimize=True, lextab="lextab")
+    return _lexer
+
+
+def get_parser():
+    global _parser
+    if _parser is None:
+        with _build_lock:
+            if _parser is None:
+                _parser = yacc.yacc(optimize=True, debug=False, write_tables=False, errorlog=yacc.NullLogger())
+    return _parser
+
+
+def thread_lexer():
+    """The current thread's clone of the lexer"""
+    lx = getattr(_local, "lexer", None)
+    if lx is None:
+        lx = _local.lexer = get_lexer().clone()
+    return lx
+
+
+def thread_parser():
+    """The current thread's copy of the parser, sharing the read-only LALR tables"""
+    ps = getattr(_local, "parser", None)
+    if ps is None:
+        ps = _local.parser = copy.copy(get_parser())
+    return ps
+
+
+def build_tables():
+    """Regenerate lextab.py and parsetab.py in the package; run whenever the grammar changes"""
+    global _lexer, _parser
+    outputdir = os.path.dirname(__file__)
+    for name in ("lextab", "parsetab"):
+        sys.modules.pop(f"{__package__}.{name}", None)
+        fn = os.path.join(outputdir, f"{name}.py")
+        if os.path.exists(fn):
+            os.remove(fn)
+    _lexer = lex.lex(optimize=True, lextab="lextab", outputdir=outputdir)
+    _parser = yacc.yacc(debug=False, outputdir=outputdir, errorlog=yacc.NullLogger())
+
+
+def __getattr__(name):
+    # Module level lexer and parser, kept for compatibility
+    if name == "lexer":
+        return get_lexer()
+    elif name == "parser":
+        return get_parser()
+    raise AttributeError(f"module {__name__} has no attribute {name}")
+
+
+# Hand written alternative to PLY for the same grammar: a single master regex scan for the tokens
+# (built from the t_ rules above, in the order PLY tries them) and an operator precedence parser for the rules.
+_lex_rules = (
+    t_AND,
+    t_OR,
+    t_NOT,
+    t_LPAREN,
+    t_RPAREN,
+    t_COLON,
+    t_QUOTED_STRING,
+    t_WORD,
+    t_ARROW,
+    t_COMPARATOR,
+    t_newline,
+)
+_master_re = re.compile("|".join(f"(?P<{f.__name__[2:]}>{f.__doc__})" for f in _lex_rules), re.VERBOSE)
+
+
+def scan(query_string):
+    """Tokenize query_string as the PLY lexer does, returning a list of (type, value, lineno)"""
+    toks = []
+    pos = 0
+    lineno = 1
+    end = len(query_string)
+    match = _master_re.match
+    while pos < end:
+        if query_string[pos] in t_ignore:
+            pos += 1
+            continue
+        m = match(query_string, pos)
+        if m is None:
+            report_error(f"Illegal character '{query_string[pos]}'")
+            pos += 1
+            continue
+        kind = m.lastgroup
+        value = m.group()
+        pos = m.end()
+        if kind == "newline":
+            lineno += len(value)
+        elif kind == "QUOTED_STRING":
+            toks.append((kind, value[1:-1], lineno))
+        else:
+            toks.append((kind, value, lineno))
+    return toks
+
+
+class DescentSyntaxError(Exception):
+    pass
+
+
+class DescentParser:
+    """Hand written parser accepting the same language, and building the same AST, as the PLY grammar
+
+    Unlike PLY it doesn't attempt error recovery: any syntax error is reported the same way as p_error
+    does and parse() returns None.
+    """
+
+    def parse(self, query_string, lexer=None):
+        # lexer is accepted for call compatibility with the PLY parser, and ignored
+        return self.parse_tokens(scan(query_string))
+
+    def parse_tokens(self, toks):
+        """Parse the result of scan()"""
+        state = _DescentState(toks)
+        try:
+            result = state.expression()
+            if state.pos < len(state.toks):
+                state.error()
+            return result
+        except DescentSyntaxError as e:
+            report_error(str(e))
+            return None
+
+
+class _TokenReplay:
+    """Stands in for a PLY lexer, returning tokens that have already been read"""
+
+    def __init__(self, toks):
+        self.toks = iter(toks)
+
+    def input(self, data):
+        pass
+
+    def token(self):
+        return next(self.toks, None)
+
+
+class _DescentState:
+    """Tokens and position for a single parse, so DescentParser itself holds no state"""
+
+    def __init__(self, toks):
+        self.toks = toks
+        self.pos = 0
+
+    def peek(self):
+        if self.pos < len(self.toks):
+            return self.toks[self.pos][0]
+        return None
+
+    def error(self):
+        if self.pos < len(self.toks):
+            kind, value, lineno = self.toks[self.pos]
+            raise DescentSyntaxError(f"Syntax error at token {kind} ('{value}') at line {lineno}")
+        raise DescentSyntaxError("Syntax error at EOF")
+
+    def expression(self):
+        # Operator precedence parsing with explicit stacks rather than recursion, so that nesting isn't
+        # limited by the interpreter: NOT binds tightest, then AND, then OR, both left associative
+        operands = []
+        ops = []
+        while True:
+            # An operand, after any NOTs and opening parentheses
+            kind = self.peek()
+            while kind == "NOT" or kind == "LPAREN":
+                ops.append(kind)
+                self.pos += 1
+                kind = self.peek()
+            if kind != "WORD" and kind != "QUOTED_STRING":
+                self.error()
+            terms = [self.term()]
+            while self.peek() in ("WORD", "QUOTED_STRING"):
+                terms.append(self.term())
+            operands.append(TermList(terms))
+
+            # Then any closing parentheses, and an operator or the end of the expression
+            kind = self.peek()
+            while kind == "RPAREN":
+                self.reduce(operands, ops, ("NOT", "AND", "OR"))
+                if not ops:
+                    self.error()
+                ops.pop()
+                self.pos += 1
+                kind = self.peek()
+            if kind == "AND":
+                self.reduce(operands, ops, ("NOT", "AND"))
+            elif kind == "OR":
+                self.reduce(operands, ops, ("NOT", "AND", "OR"))
+            else:
+                self.reduce(operands, ops, ("NOT", "AND", "OR"))
+                if ops:
+                    # An unclosed parenthesis
+                    self.error()
+                return operands[0]
+            ops.append(kind)
+            self.pos += 1
+
+    @staticmethod
+    def reduce(operands, ops, what):
+        # Apply the operators in what from the top of ops to the operands
+        while ops and ops[-1] in what:
+            op = ops.pop()
+            if op == "NOT":
+                operands.append(UnaryOp("NOT", operands.pop()))
+            else:
+                right = operands.pop()
+                operands.append(BinaryOp(operands.pop(), op, right))
+
+    def term(self):
+        kind, value, _ = self.toks[self.pos]
+        self.pos += 1
+        if kind == "QUOTED_STRING":
+            return Term(value)
+        fields = [value]
+        while self.peek() == "ARROW":
+            self.pos += 1
+            if self.peek() != "WORD":
+                self.error()
+            fields.append(self.toks[self.pos][1])
+            self.pos += 1
+        kind = self.peek()
+        if kind == "COLON" or kind == "COMPARATOR":
+            comparitor = self.toks[self.pos][1] if kind == "COMPARATOR" else None
+            self.pos += 1
+            if self.peek() not in ("WORD", "QUOTED_STRING"):
+                self.error()
+            value = self.toks[self.pos][1]
+            self.pos += 1
+            if comparitor:
+                return Term(value, fields=fields, comparitor=comparitor)
+            return Term(value, fields=fields)
+        elif len(fields) > 1:
+            # A field chain must be followed by a value
+            self.error()
+        return Term(value)
+
+
+backends = ("ply", "descent")
 
 
 class QueryParser:
     """
-    A parser for boolean queries using PLY (Python Lex-Yacc).
+    A parser for boolean queries using PLY (Python Lex-Yacc), or a hand written parser
+    for the same grammar with backend="descent".
 
     This parser handles boolean expressions with AND, OR, NOT operators,
     parentheses for grouping, field-qualified terms, and term lists.
@@ -374,16 +647,135 @@ class QueryParser:
         ast = parser.parse('title:python author:gibson "machine learning" OR tags:scala')
     """
 
-    def __init__(self):
-        """Initialize the parser with lexer and parser instances."""
-        self.lexer = lexer
-        self.parser = parser
+    def __init__(self, backend="ply", cache_size=0, cache_ttl=None):
+        """Initialize the parser with lexer and parser instances.
 
-    def make_query(self, query_string, scope=None):
-        api = LuxAPI(scope)
-        result = self.parser.parse(query_string, lexer=self.lexer)
+        With cache_size, parse results for up to that many query strings (and scopes, for query_json)
+        are kept for cache_ttl seconds, or until the LUX configuration is reloaded.
+        """
+        if backend not in backends:
+            raise ValueError(f"Unknown parser backend {backend}; known: {', '.join(backends)}")
+        self.backend = backend
+        self.descent_parser = DescentParser()
+        self.cache = LRUCache(cache_size, cache_ttl, config=LuxAPI.config) if cache_size else None
+
+    # Instances can be shared between threads: the PLY lexer and parser used are the calling thread's own
+
+    @property
+    def lexer(self):
+        if self.backend == "ply":
+            return thread_lexer()
+        return None
+
+    @property
+    def parser(self):
+        if self.backend == "ply":
+            return thread_parser()
+        return self.descent_parser
+
+    def run_parser(self, query_string):
+        if instrument.enabled:
+            return self.run_parser_instrumented(query_string)
+        lexer = self.lexer
+        if lexer is not None:
+            # Line numbers in error messages are per query
+            lexer.lineno = 1
+        return self.parser.parse(query_string, lexer=lexer)
+
+    def run_parser_instrumented(self, query_string):
+        # As run_parser, but reading all the tokens first so that lexing and parsing are timed separately
+        lexer = self.lexer
+        with instrument.stage("lex"):
+            if lexer is None:
+                toks = scan(query_string)
+            else:
+                lexer.lineno = 1
+                lexer.input(query_string)
+                toks = list(iter(lexer.token, None))
+        instrument.count("tokens", len(toks))
+        with instrument.stage("parse"):
+            if lexer is None:
+                return self.descent_parser.parse_tokens(toks)
+            return self.parser.parse(query_string, lexer=_TokenReplay(toks))
+
+    def run_parser_strict(self, query_string):
+        """As run_parser, but raising ValueError on any syntax error rather than recovering from it"""
+        _local.errors = errors = []
+        try:
+            ast = self.run_parser(query_string)
+        finally:
+            _local.errors = None
+        if errors or ast is None:
+            raise ValueError(errors[0] if errors else "Syntax error")
+        return ast
+
+    def cached_parse(self, query_string):
+        if self.cache is None:
+            return self.run_parser(query_string)
+        key = ("ast", query_string)
+        result = self.cache.get(key)
+        if result is MISSING:
+            result = self.run_parser(query_string)
+            self.cache.put(key, result)
+        return result
+
+    def make_query(self, query_string, scope=None, budget=None):
+        # With a budget, building stops with ValueError as soon as the query's complexity exceeds it
+        api = LuxAPI(scope, budget)
+        result = self.cached_parse(query_string)
+        if instrument.enabled:
+            with instrument.stage("to_luxql"):
+                return result.to_luxql(api)
         return result.to_luxql(api)
 
+    def query_json(self, query_string, scope=None, encoded=False):
+        """Return make_query(query_string, scope).to_json(encoded), from the cache if possible
+
+        Cached results are shared, so must not be modified.
+        """
+        if self.cache is None:
+            return self.make_query(query_string, scope).to_json(encoded)
+        key = ("json", query_string, scope, encoded)
+        result = self.cache.get(key)
+        if result is MISSING:
+            result = self.make_query(query_string, scope).to_json(encoded)
+            self.cache.put(key, result)
+        return result
+
+    def prepare(self, template, scope=None):
+        """Build and validate template, with $1, $2, ... in place of leaf values, once
+
+        Returns a PreparedQuery whose bind() gives the JSON for the query with the values filled in."""
+        try:
+            ast = self.run_parser_strict(param_words(template))
+        except ValueError as e:
+            raise ValueError(f"Couldn't parse query template: {template}: {e}") from None
+        # Give placeholder terms values that will pass validation, noting their positions among the leaves
+        params = {}
+        idx = 0
+        stack = [ast]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, TermList):
+                stack.extend(reversed(node.terms))
+            elif isinstance(node, UnaryOp):
+                stack.append(node.operand)
+            elif isinstance(node, BinaryOp):
+                stack.append(node.right)
+                stack.append(node.left)
+            else:
+                num = param_number(node.value)
+                if num is not None:
+                    params[idx] = num
+                    field = node.fields[-1] if node.fields else "text"
+                    node.value = stand_in(LuxAPI.config, field, node.comparitor)
+                idx += 1
+        return PreparedQuery(ast.to_luxql(LuxAPI(scope)), params)
+
+    def cache_stats(self):
+        """Hit, miss, eviction and expiration counts for the parse cache"""
+        return self.cache.stats() if self.cache is not None else None
+
     def parse(self, query_string):
         """
         Parse a boolean query string and return an Abstract Syntax Tree (AST).
@@ -399,7 +791,7 @@ class QueryParser:
             # Returns: BinaryOp with field-qualified terms
         """
         try:
-            result = self.parser.parse(query_string, lexer=self.lexer)
+            result = self.cached_parse(query_string)
             return result
         except Exception as e:
             print(f"Parsing error: {e}")
@@ -419,10 +811,13 @@ class QueryParser:
             tokens = parser.tokenize('title:a author:"John Doe" AND content:b')
             # Returns: [('WORD', 'title'), ('COLON', ':'), ('WORD', 'a'), ...]
         """
-        self.lexer.input(query_string)
+        lexer = self.lexer
+        if lexer is None:
+            return [(t[0], t[1]) for t in scan(query_string)]
+        lexer.input(query_string)
         tokens = []
         while True:
-            tok = self.lexer.token()
+            tok = lexer.token()
             if not tok:
                 break
             tokens.append((tok.type, tok.value))
@@ -442,6 +837,15 @@ def print_ast(node, indent=0):
         print_ast(ast)
         # Output shows field-qualified terms in the structure
     """
+    # An explicit stack rather than recursion, so that very deep trees can be printed
+    stack = [(node, indent)]
+    while stack:
+        node, indent = stack.pop()
+        print_ast_node(node, indent, stack)
+
+
+def print_ast_node(node, indent, stack):
+    # Print one node of the AST, pushing its children onto stack
     spaces = "  " * indent
 
     if isinstance(node, Term):
@@ -477,12 +881,12 @@ def print_ast(node, indent=0):
 
     elif isinstance(node, UnaryOp):
         print(f"{spaces}UnaryOp: {node.op}")
-        print_ast(node.operand, indent + 1)
+        stack.append((node.operand, indent + 1))
 
     elif isinstance(node, BinaryOp):
         print(f"{spaces}BinaryOp: {node.op}")
-        print_ast(node.left, indent + 1)
-        print_ast(node.right, indent + 1)
+        stack.append((node.right, indent + 1))
+        stack.append((node.left, indent + 1))
 
 
 # Quick usage examples and basic testing
@@ -0,0 +1,78 @@
+"""HTTP transports used by LuxConfig to fetch the search configuration and statistics
+
+A transport has a single method, get(url, headers), returning (status, response headers, data),
+where data is the decoded JSON body for a 200 response and None otherwise. Anything with that
+method can be passed to LuxConfig, e.g. a StaticTransport over fixture files in tests.
+"""
+
+import json
+import threading
+
+
+class RequestsTransport(object):
+    """Fetches with one pooled requests.Session, so connections are reused across fetches and LuxConfigs"""
+
+    def __init__(self, pool_size=10, timeout=10):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.session = None
+        self.lock = threading.Lock()
+
+    def get_session(self):
+        if self.session is None:
+            with self.lock:
+                if self.session is None:
+                    # Deferred so that importing luxql doesn't pay for requests
+                    import requests
+                    from requests.adapters import HTTPAdapter
+
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    self.session = session
+        return self.session
+
+    def get(self, url, headers=None):
+        resp = self.get_session().get(url, headers=headers or {}, timeout=self.timeout)
+        data = resp.json() if resp.status_code == 200 else None
+        return resp.status_code, resp.headers, data
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+
+class StaticTransport(object):
+    """Serves fixed responses: a dict of url to either the JSON data or the path of a JSON file"""
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def get(self, url, headers=None):
+        self.requests.append(url)
+        if url not in self.responses:
+            return 404, {}, None
+        data = self.responses[url]
+        if isinstance(data, str):
+            with open(data) as fh:
+                data = json.load(fh)
+        return 200, {}, data
+
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def shared_transport(pool_size=10, timeout=10):
+    """The process-wide RequestsTransport for these settings, created on first use"""
+    key = (pool_size, timeout)
+    transport = _shared.get(key)
+    if transport is None:
+        with _shared_lock:
+            transport = _shared.get(key)
+            if transport is None:
+                transport = _shared[key] = RequestsTransport(pool_size, timeout)
+    return transport
@@ -0,0 +1,267 @@
+"""Compact binary encoding of built query trees, for passing validated queries between processes
+
+Field names, booleans, comparitors and options are written as indexes into tables compiled from
+the LuxConfig, and each node starts with a varint tag holding its type and table index. The
+header carries a fingerprint of the configuration, so data encoded under a different
+configuration is rejected rather than misread. Decoding rebuilds the tree directly, without
+re-running validation, so only data from trusted sources should be decoded.
+
+Layout: b"LQ", version, 8 byte fingerprint, varint root (0 for a bare node, 1 for an API with
+no scope, 2 + scope index for an API), then the nodes depth first. A node's tag is
+kind + 4 * index: booleans (kind 0) are followed by a varint count of children, relationships
+(kind 1) by their child, and leaves (kind 2) by a flags byte, the optional comparitor, options
+and weight, and the value as a varint length and UTF-8 bytes. The flags record whether the value
+was a str, int, float or bool, so it comes back as the same type; any other type comes back as
+the str that json_value() gives for it.
+"""
+
+import hashlib
+import json
+import weakref
+
+from .luxql import LuxAPI, LuxBoolean, LuxLeaf, LuxRelationship
+
+MAGIC = b"LQ"
+VERSION = 1
+
+BOOLEAN = 0
+RELATIONSHIP = 1
+LEAF = 2
+
+HAS_COMPARITOR = 1
+HAS_OPTIONS = 2
+HAS_WEIGHT = 4
+COMPLETE = 8
+# Bits 4 and 5 of the flags: the type of the value
+VALUE_TYPES = (str, int, float, bool)
+VALUE_SHIFT = 4
+
+CORRUPT = "Truncated or corrupt encoded query"
+
+_tables = weakref.WeakKeyDictionary()
+
+
+class Tables(object):
+    """The lookups from names to indexes, and back, for one generation of a LuxConfig"""
+
+    def __init__(self, config, state):
+        mc = config.module_config
+        self.state = state
+        self.fields = sorted(state.fields)
+        self.booleans = list(mc["booleans"])
+        self.comparitors = list(mc["comparitors"])
+        self.options = sorted(state.possible_options)
+        self.scopes = list(state.scopes)
+        self.field_index = {f: i for i, f in enumerate(self.fields)}
+        self.boolean_index = {b: i for i, b in enumerate(self.booleans)}
+        self.comparitor_index = {c: i for i, c in enumerate(self.comparitors)}
+        self.option_index = {o: i for i, o in enumerate(self.options)}
+        self.scope_index = {s: i for i, s in enumerate(self.scopes)}
+
+        # Anything that changes the meaning of an index, or of a decoded tree, changes the fingerprint
+        js = {
+            "terms": state.lux_config["terms"],
+            "options": state.lux_config["options"],
+            "booleans": self.booleans,
+            "comparitors": self.comparitors,
+        }
+        digest = hashlib.sha1(json.dumps(js, sort_keys=True, separators=(",", ":")).encode("utf-8"))
+        self.fingerprint = digest.digest()[:8]
+
+
+def get_tables(config):
+    state = config.state
+    cached = _tables.get(config)
+    if cached is None or cached.state is not state:
+        cached = _tables[config] = Tables(config, state)
+    return cached
+
+
+def fingerprint(config=None):
+    """8 byte fingerprint of the configuration that encoded data depends on"""
+    return get_tables(config if config is not None else LuxAPI.config).fingerprint
+
+
+def _write_varint(out, n):
+    while n > 0x7F:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _read_varint(data, pos):
+    n = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise ValueError(CORRUPT)
+        b = data[pos]
+        pos += 1
+        n |= (b & 0x7F) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+def _write_str(out, s):
+    b = s.encode("utf-8")
+    _write_varint(out, len(b))
+    out += b
+
+
+def _read_str(data, pos):
+    n, pos = _read_varint(data, pos)
+    if pos + n > len(data):
+        raise ValueError(CORRUPT)
+    return data[pos : pos + n].decode("utf-8"), pos + n
+
+
+def dumps(node):
+    """Encode the query at node (a LuxAPI, or any query node) as bytes"""
+    tables = get_tables(node.config)
+    out = bytearray(MAGIC)
+    out.append(VERSION)
+    out += tables.fingerprint
+    if isinstance(node, LuxAPI):
+        if not node.children:
+            raise ValueError("No query has been defined")
+        _write_varint(out, 2 + tables.scope_index[node.provides_scope] if node.provides_scope else 1)
+        node = node.children[0]
+    else:
+        _write_varint(out, 0)
+
+    field_index = tables.field_index
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, LuxLeaf):
+            _write_varint(out, LEAF + 4 * field_index[node.field])
+            flags = 0
+            if node.comparitor:
+                flags |= HAS_COMPARITOR
+            if node.options:
+                flags |= HAS_OPTIONS
+            if node.weight:
+                flags |= HAS_WEIGHT
+            if node.complete:
+                flags |= COMPLETE
+            value_type = type(node.value)
+            if value_type in VALUE_TYPES:
+                flags |= VALUE_TYPES.index(value_type) << VALUE_SHIFT
+            out.append(flags)
+            if node.comparitor:
+                _write_varint(out, tables.comparitor_index[node.comparitor])
+            if node.options:
+                _write_varint(out, len(node.options))
+                for o in node.options:
+                    _write_varint(out, tables.option_index[o])
+            if node.weight:
+                _write_str(out, json.dumps(node.weight))
+            _write_str(out, node.json_value())
+        elif isinstance(node, LuxBoolean):
+            if not node.children:
+                raise ValueError(f"Boolean {node.field} is missing children")
+            _write_varint(out, BOOLEAN + 4 * tables.boolean_index[node.field])
+            _write_varint(out, len(node.children))
+            stack.extend(reversed(node.children))
+        else:
+            if not node.children:
+                raise ValueError(f"Relationship {node.field} is missing children")
+            _write_varint(out, RELATIONSHIP + 4 * field_index[node.field])
+            stack.append(node.children[0])
+    return bytes(out)
+
+
+def loads(data):
+    """Rebuild a query encoded by dumps(), without validating it; returns a LuxAPI or the top node
+
+    The nodes are built under the configuration every node shares, LuxAPI.config. Raises ValueError
+    if data isn't an encoded query, was encoded with a different configuration, or is truncated or corrupt.
+    """
+    tables = get_tables(LuxAPI.config)
+    if data[:2] != MAGIC:
+        raise ValueError("Not an encoded query")
+    if len(data) < 11:
+        raise ValueError(CORRUPT)
+    if data[2] != VERSION:
+        raise ValueError(f"Unsupported encoding version {data[2]}")
+    if data[3:11] != tables.fingerprint:
+        raise ValueError("Query was encoded with a different LUX configuration")
+    try:
+        return _decode(data, tables)
+    except (IndexError, KeyError, ValueError):
+        # Including indexes outside the tables, and values that can't be decoded
+        raise ValueError(CORRUPT) from None
+
+
+def _decode(data, tables):
+    root, pos = _read_varint(data, 11)
+    api = None
+    if root:
+        api = LuxAPI(tables.scopes[root - 2] if root > 1 else None)
+
+    fields = tables.fields
+    state = tables.state
+    top = None
+    # Frames of [parent, children still to read]
+    stack = [[api, 1]]
+    while stack:
+        frame = stack[-1]
+        if not frame[1]:
+            stack.pop()
+            continue
+        frame[1] -= 1
+        parent = frame[0]
+        tag, pos = _read_varint(data, pos)
+        kind = tag & 3
+        idx = tag >> 2
+        if kind == LEAF:
+            field = fields[idx]
+            if pos >= len(data):
+                raise ValueError(CORRUPT)
+            flags = data[pos]
+            pos += 1
+            comparitor = None
+            options = []
+            weight = 0
+            if flags & HAS_COMPARITOR:
+                n, pos = _read_varint(data, pos)
+                comparitor = tables.comparitors[n]
+            if flags & HAS_OPTIONS:
+                count, pos = _read_varint(data, pos)
+                for _ in range(count):
+                    n, pos = _read_varint(data, pos)
+                    options.append(tables.options[n])
+            if flags & HAS_WEIGHT:
+                weight, pos = _read_str(data, pos)
+                weight = json.loads(weight)
+            value, pos = _read_str(data, pos)
+            value_type = VALUE_TYPES[(flags >> VALUE_SHIFT) & 3]
+            if value_type is bool:
+                value = value == "1"
+            elif value_type is not str:
+                value = value_type(value)
+            node = LuxLeaf._restore(
+                state,
+                field,
+                parent,
+                value=value,
+                comparitor=comparitor,
+                options=options,
+                weight=weight,
+                complete=bool(flags & COMPLETE),
+            )
+        elif kind == BOOLEAN:
+            node = LuxBoolean._restore(state, tables.booleans[idx], parent)
+            count, pos = _read_varint(data, pos)
+            stack.append([node, count])
+        elif kind == RELATIONSHIP:
+            node = LuxRelationship._restore(state, fields[idx], parent)
+            stack.append([node, 1])
+        else:
+            raise ValueError(CORRUPT)
+        if top is None:
+            top = node
+    if pos != len(data):
+        raise ValueError(CORRUPT)
+    return api if api is not None else top
@@ -1,3 +1,9 @@
 from setuptools import find_packages, setup
 
-setup(name="luxql", version="0.2.0", packages=find_packages(), install_requires=["requests", "ply"])
+setup(
+    name="luxql",
+    version="0.2.0",
+    packages=find_packages(),
+    package_data={"luxql": ["*.json"]},
+    install_requires=["requests", "ply"],
+)
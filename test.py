@@ -1,5 +1,34 @@
+import contextlib
+import io
+import json
+import os
+import random
+import threading
+import tempfile
+import time
 import unittest
 from luxql import *
+from luxql import QueryParser
+from luxql.luxql import config as default_config
+
+# Fixed estimates, so that complexity tests don't change when the shipped stats snapshot is updated
+TEST_STATS = {
+    "estimates": {
+        "searchScopes": {
+            "agent": 300000,
+            "concept": 100000,
+            "event": 20000,
+            "item": 2000000,
+            "place": 50000,
+            "set": 1000,
+            "work": 500000,
+        }
+    }
+}
+
+
+def setUpModule():
+    LuxAPI.config.lux_stats = TEST_STATS
 
 
 class TestLuxQL(unittest.TestCase):
@@ -173,6 +202,821 @@ class TestLuxQL(unittest.TestCase):
     def test_relationship_not_relationship(self):
         self.assertRaises(ValueError, LuxRelationship, "name")
 
+    def test_config_lazy(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cfg = LuxConfig(dict(default_config, snapshot_dir=tmp))
+            # Nothing is read until the config is used
+            self.assertFalse("state" in cfg.__dict__)
+            self.assertRaises(ValueError, getattr, cfg, "scopes")
+
+    def test_config_snapshot(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cfg = LuxConfig(dict(default_config, snapshot_dir=tmp))
+            stats = {"estimates": {"searchScopes": {"item": 1000}}}
+            cfg.write_snapshot(cfg.lux_stats_path, cfg.remote_lux_stats, stats)
+            self.assertEqual(cfg.lux_stats, stats)
+
+            # Stale snapshots are still used when the network isn't allowed
+            with open(cfg.lux_stats_path) as fh:
+                js = json.load(fh)
+            js["fetched"] = time.time() - 10 * default_config["snapshot_ttl"]
+            with open(cfg.lux_stats_path, "w") as fh:
+                json.dump(js, fh)
+            cfg2 = LuxConfig(dict(default_config, snapshot_dir=tmp))
+            self.assertEqual(cfg2.lux_stats, stats)
+
+    def test_config_no_stats(self):
+        from luxql.luxql import LuxScope
+        from luxql.stream import process_queries
+
+        fn = os.path.join(os.path.dirname(os.path.abspath(__file__)), "luxql", "advanced-search-config.json")
+        with tempfile.TemporaryDirectory() as tmp:
+            # The snapshot shipped with the package is used by default
+            shipped = LuxConfig(default_config)
+            self.assertTrue(shipped.lux_stats["estimates"]["searchScopes"].get("item", 0) > 1)
+
+            # Without any snapshot, estimates fall back to neutral, with a warning
+            cfg = LuxConfig(dict(default_config, snapshot_dir=tmp), lux_config=fn)
+            with self.assertWarns(UserWarning):
+                self.assertEqual(cfg.lux_stats, {"estimates": {"searchScopes": {}}})
+            with open(os.path.join(tmp, "stats.json"), "w") as fh:
+                fh.write("not json")
+            self.assertRaises(ValueError, getattr, LuxConfig(dict(default_config, snapshot_dir=tmp)), "lux_stats")
+            missing = LuxConfig(default_config, lux_stats="/nonexistent.json")
+            self.assertRaises(ValueError, getattr, missing, "lux_stats")
+
+            saved = LuxScope.config
+            LuxScope.config = cfg
+            try:
+                reader = JsonReader(cfg)
+                query = {"AND": [{"name": "fish"}, {"carries": {"name": "boat"}}]}
+                top = reader.read(query, "item")
+                self.assertTrue(top.calculate_complexity() > 0)
+                self.assertEqual(optimize(top).to_json(), top.to_json())
+                (result,) = process_queries([query], "item", complexity=True, reader=reader)
+                self.assertTrue(result["ok"])
+                self.assertRaisesRegex(ValueError, "budget", reader.read, query, "item", budget=1)
+            finally:
+                LuxScope.config = saved
+
+    def test_config_pinned(self):
+        fn = os.path.join(os.path.dirname(os.path.abspath(__file__)), "luxql", "advanced-search-config.json")
+        cfg = LuxConfig(default_config, lux_config=fn)
+        self.assertTrue("item" in cfg.scopes)
+        self.assertRaises(ValueError, LuxConfig(default_config, lux_config="/nonexistent.json").load_config)
+
+    def test_config_index(self):
+        cfg = LuxAPI("item").config
+        info = cfg.index[("item", "name")]
+        self.assertEqual(info.relation, "text")
+        self.assertTrue(info.is_leaf)
+        self.assertTrue("punctuation-sensitive" in info.options)
+        self.assertFalse(cfg.index[("item", "carries")].is_leaf)
+        self.assertEqual(cfg.fields["carries"].parent_scopes, tuple(cfg.inverted["carries"]))
+        with self.assertRaises(TypeError):
+            cfg.index[("item", "fish")] = info
+
+    validate_queries = [
+        {"name": "fish"},
+        {"AND": [{"name": "fish"}, {"carries": {"name": "fish"}}]},
+        {"OR": [{"producedDate": "2000-01-01T00:00:00", "_comp": ">="}, {"NOT": [{"isOnline": True}]}]},
+        {"name": "fish", "_options": ["punctuation-sensitive"], "_weight": 3},
+        {"name": "fish", "_options": ["fish"]},
+        {"name": 1},
+        {"fish": "fish"},
+        {"XOR": [{"name": "fish"}]},
+        {"carries": "fish"},
+        {"name": {"name": "fish"}},
+        {"foundedBy": {"name": "fish"}},
+        {"producedDate": "fish", "_comp": ">"},
+        {"producedDate": "2000-01-01T00:00:00"},
+        {"producedDate": "2000-01-01T00:00:00", "_comp": "~"},
+        {"isOnline": "yes"},
+        {"_comp": ">"},
+    ]
+
+    def test_reader_validate(self):
+        reader = JsonReader(LuxAPI("item").config)
+        for q in self.validate_queries:
+            try:
+                reader.read(q, "item")
+                expected = (True, None)
+            except ValueError as e:
+                expected = (False, str(e))
+            self.assertEqual(reader.validate(q, "item"), expected, q)
+        self.assertEqual(reader.validate({}, "item"), (False, "Query is empty"))
+        self.assertEqual(reader.validate({"name": "fish"}, "fish"), (False, "Unknown query scope 'fish'"))
+
+    def test_batch_validate_many(self):
+        from luxql import batch
+        from luxql.batch import validate_many
+        from luxql.luxql import LuxScope
+
+        queries = [{"name": "fish"}, {"fish": "fish"}, "name:fish AND carries->name:boat"] * 20
+        inline = list(validate_many(queries, "item", workers=1))
+        self.assertEqual([r[0] for r in inline], list(range(len(queries))))
+        self.assertEqual(inline[0], (0, True, {"name": "fish"}))
+        self.assertEqual(inline[1], (1, False, "No possible scope for Leaf component 'fish'"))
+        self.assertEqual(inline[2][2], {"AND": [{"name": "fish"}, {"carries": {"name": "boat"}}]})
+        pooled = list(validate_many(queries, "item", workers=2, chunksize=7))
+        self.assertEqual(pooled, inline)
+
+        # Workers check queries against the config the nodes use, as it is in memory, without reloading it
+        cfg = LuxScope.config
+        state = cfg.state
+        js = json.loads(json.dumps(cfg.lux_config))
+        js["terms"]["item"]["fishName"] = js["terms"]["item"]["name"]
+        cfg.swap_state(cfg.compile_config(js))
+        batch._reader = None
+        try:
+            results = list(validate_many([{"fishName": "x"}], "item", workers=1))
+            self.assertEqual(results, [(0, True, {"fishName": "x"})])
+            self.assertEqual(cfg.generation, state.generation + 1)
+        finally:
+            cfg.state = state
+            batch._reader = None
+
+    def test_stream_pipeline(self):
+        from luxql.stream import read_queries, run_pipeline
+
+        queries = [{"name": f"fish {i}"} for i in range(50)] + [{"fish": "fish"}]
+        fh = io.StringIO(json.dumps(queries, indent=2))
+        self.assertEqual(list(read_queries(fh, chunk_size=16)), queries)
+
+        fh = io.StringIO("\n".join(json.dumps(q) for q in queries) + "\n")
+        out = io.StringIO()
+        self.assertEqual(run_pipeline(fh, out, "item", complexity=True), len(queries))
+        lines = [json.loads(x) for x in out.getvalue().splitlines()]
+        self.assertEqual(lines[0], {"index": 0, "ok": True, "complexity": 1, "query": {"name": "fish 0"}})
+        self.assertFalse(lines[-1]["ok"])
+        self.assertRaises(ValueError, list, read_queries(io.StringIO('[{"name": "fish"}, {"name"')))
+
+        # A malformed line is reported with its line number, and the rest are still read
+        fh = io.StringIO('\n{"name": "fish"}\n{"name": \n\n{"name": "boat"}\n')
+        out = io.StringIO()
+        self.assertEqual(run_pipeline(fh, out, "item"), 3)
+        lines = [json.loads(x) for x in out.getvalue().splitlines()]
+        self.assertEqual([x["ok"] for x in lines], [True, False, True])
+        self.assertEqual(lines[1]["line"], 3)
+        self.assertEqual(lines[2]["query"], {"name": "boat"})
+
+        # Entries much larger than the chunk size
+        queries = [{"OR": [{"name": f"fish {i} {j}"} for j in range(200)]} for i in range(5)]
+        self.assertEqual(list(read_queries(io.StringIO(json.dumps(queries)), chunk_size=7)), queries)
+
+        # A malformed entry fails without reading the rest of the array
+        class Counting(io.StringIO):
+            read_chars = 0
+
+            def read(self, size=-1):
+                data = super().read(size)
+                self.read_chars += len(data)
+                return data
+
+        entries = [json.dumps({"name": f"fish {i}"}) for i in range(2000)]
+        entries.insert(3, '{"name": }')
+        fh = Counting("[" + ", ".join(entries) + "]")
+        self.assertRaises(ValueError, list, read_queries(fh, chunk_size=64))
+        self.assertLess(fh.read_chars, 1024)
+        split = '[{"name": "fi\\u00f1sh", "x": -Infinity}, {"name": "ca\\"t"}]'
+        self.assertEqual(len(list(read_queries(io.StringIO(split), chunk_size=3))), 2)
+
+    def test_structural_hash(self):
+        from luxql import luxy
+
+        reader = JsonReader(LuxAPI("item").config)
+        js = reader.read({"AND": [{"carries": {"name": "boat"}}, {"name": "fish"}, {"isOnline": True}]}, "item")
+        parsed = QueryParser().make_query("name:fish AND carries->name:boat AND isOnline:1", "item")
+        built = luxy.AND(luxy.isOnline("1"), luxy.name("fish"), luxy.carries(luxy.name("boat")))
+        self.assertEqual(js.canonical(), parsed.canonical())
+        self.assertEqual(js.structural_hash(), parsed.structural_hash())
+        self.assertEqual(js.structural_hash(), built.structural_hash())
+        self.assertEqual(js.parent.structural_hash(), parsed.parent.structural_hash())
+
+        # Duplicates and option order don't matter, the operator and scope do
+        a = reader.read({"OR": [{"name": "fish", "_options": ["stemmed", "punctuation-sensitive"]}] * 2}, "item")
+        b = reader.read({"name": "fish", "_options": ["punctuation-sensitive", "stemmed"]}, "item")
+        self.assertEqual(a.structural_hash(), b.structural_hash())
+        c = reader.read({"NOT": [{"name": "fish"}]}, "item")
+        self.assertNotEqual(b.structural_hash(), c.structural_hash())
+        d = reader.read({"name": "fish", "_options": ["punctuation-sensitive", "stemmed"]}, "work")
+        self.assertNotEqual(b.parent.structural_hash(), d.parent.structural_hash())
+
+    def test_to_json_cache(self):
+        api = LuxAPI("item")
+        bl = LuxBoolean("AND", parent=api)
+        leaf = LuxLeaf("name", value="fish", parent=bl)
+        js = api.to_json()
+        self.assertTrue(api.to_json() is js)
+        self.assertEqual(api.to_json(encoded=True), b'{"AND": [{"name": "fish"}]}')
+
+        # Adding anywhere below invalidates up to the root
+        rel = LuxRelationship("carries")
+        bl.add(rel)
+        self.assertTrue(rel.parent is bl)
+        rel.add(LuxLeaf("name", value="boat"))
+        self.assertEqual(api.to_json(), {"AND": [{"name": "fish"}, {"carries": {"name": "boat"}}]})
+        self.assertEqual(json.loads(api.to_json(encoded=True)), api.to_json())
+
+        leaf.value = "cat"
+        leaf.invalidate()
+        self.assertEqual(api.to_json()["AND"][0], {"name": "cat"})
+
+    def test_optimize(self):
+        q = QueryParser().make_query(
+            'producedDate>"1900-01-01" AND name:a AND (name:b OR name:c) AND name:a', "item"
+        )
+        api = optimize(q.parent)
+        self.assertEqual(
+            api.to_json(),
+            {
+                "AND": [
+                    {"name": "a"},
+                    {"OR": [{"name": "b"}, {"name": "c"}]},
+                    {"producedDate": "1900-01-01", "_comp": ">"},
+                ]
+            },
+        )
+        self.assertTrue(all(x.parent is api.children[0] for x in api.children[0].children))
+
+        api = LuxAPI("item")
+        rel = LuxRelationship("carries", parent=api)
+        bl = LuxBoolean("OR", parent=rel)
+        LuxLeaf("name", value="fish", parent=LuxBoolean("OR", parent=bl))
+        self.assertEqual(optimize(api).to_json(), {"carries": {"name": "fish"}})
+        self.assertTrue(rel.children[0].parent is rel)
+
+    def test_optimize_ranges(self):
+        from luxql.optimizer import is_unsatisfiable
+
+        parser = QueryParser()
+
+        def opt(q):
+            return optimize(parser.make_query(q, "item").parent)
+
+        api = opt('producedDate>="1900" AND producedDate<="1950-06-01" AND producedDate>"1800" AND name:x')
+        self.assertEqual(
+            api.to_json(),
+            {
+                "AND": [
+                    {"name": "x"},
+                    {"producedDate": "1900", "_comp": ">="},
+                    {"producedDate": "1950-06-01", "_comp": "<="},
+                ]
+            },
+        )
+        self.assertEqual(opt("height>1200 AND height>1500").to_json(), {"height": "1500", "_comp": ">"})
+        self.assertEqual(opt("height==5 AND height>1 AND height<10").to_json(), {"height": "5", "_comp": "=="})
+        for q in ("height>=5 AND height<=5", "height>3 AND height!=4", "(height>3 AND height<2) OR name:x"):
+            self.assertFalse(is_unsatisfiable(opt(q)), q)
+        for q in (
+            "height>1200 AND height<1000",
+            "height>5 AND height<=5",
+            "height==5 AND height==6",
+            "height==5 AND height!=5",
+            'name:x AND producedDate>"2000-01-01T00:00:00" AND producedDate<"1999"',
+            "(height>3 AND height<2) OR (height<1 AND height>2)",
+        ):
+            api = opt(q)
+            self.assertTrue(is_unsatisfiable(api), q)
+        # Contradictory clauses are left as written
+        self.assertEqual(len(opt("height>1200 AND height<1000").children[0].children), 2)
+
+        # Partial dates are periods: a year overlaps the dates in it, and a month isn't its year
+        api = opt('producedDate=="1950" AND producedDate>="1950-06-01"')
+        self.assertFalse(is_unsatisfiable(api))
+        self.assertEqual(len(api.children[0].children), 2)
+        self.assertTrue(is_unsatisfiable(opt('producedDate>="1950-06" AND producedDate<"1950-03-01"')))
+        self.assertFalse(is_unsatisfiable(opt('producedDate>="1950-06" AND producedDate<"1950-07-01"')))
+        self.assertEqual(
+            opt('producedDate>="1950-06" AND producedDate>="1950-05-01"').to_json(),
+            {"producedDate": "1950-06", "_comp": ">="},
+        )
+
+    def test_complexity_incremental(self):
+        api = LuxAPI("item")
+        bl = LuxBoolean("AND", parent=api)
+        LuxLeaf("name", value="fish", parent=bl)
+        self.assertEqual(api.calculate_complexity(), 7)
+
+        # Adding keeps the root current without recalculating
+        LuxLeaf("producedDate", value="1900", comparitor=">", parent=bl)
+        self.assertEqual(api.complexity, 21)
+        rel = LuxRelationship("carries")
+        rel.add(LuxLeaf("name", value="boat"))
+        bl.add(rel)
+        self.assertEqual(api.complexity, 21 + 13 + 1)
+        LuxLeaf("name", value="cat", parent=LuxBoolean("OR", parent=bl))
+        self.assertEqual(api.complexity, 35 + 3)
+
+        expected = api.complexity
+        api.invalidate()
+        for x in bl.children:
+            x.invalidate()
+        self.assertEqual(api.complexity, -1)
+        self.assertEqual(api.calculate_complexity(), expected)
+
+    def test_parser_tables_current(self):
+        import ply.yacc as yacc
+        from luxql import lextab, parsetab, string_parser
+
+        # The shipped tables are loaded without checking, so check here that they match the grammar
+        pinfo = yacc.ParserReflect(vars(string_parser))
+        pinfo.get_all()
+        self.assertEqual(parsetab._lr_signature, pinfo.signature())
+        self.assertEqual(lextab._lextokens, set(string_parser.tokens))
+
+    parser_corpus = [
+        "fish",
+        '"science fiction"',
+        "title:fish author:gibson",
+        'title:"science fiction" AND author:gibson',
+        'title:python java OR author:"John Doe"',
+        "NOT title:fish AND (author:gibson OR tags:cyberpunk)",
+        "classification->name:painting AND shows->depicts->encountered->classification:fossil",
+        'creator->person->name:"John Doe" AND subject->classification->broader:art',
+        'NOT creator->name:Smith AND (about->type:book OR format->medium:"digital")',
+        'producedDate>="1900-01-01" height<10 width=3.5 depth!=2 x==1 y<=4',
+        "a OR b c AND d",
+        "NOT a b AND c",
+        "NOT NOT a",
+        "a AND NOT b OR c",
+        "((a))",
+        "a ANDROID x ORANGE",
+        "a\nb\tc",
+        "a $ b",
+    ]
+
+    def parse_quietly(self, parser, query):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            result = parser.parse(query)
+        return result, out.getvalue()
+
+    def test_parser_backends_agree(self):
+        ply = QueryParser()
+        descent = QueryParser(backend="descent")
+        for q in self.parser_corpus:
+            a, _ = self.parse_quietly(ply, q)
+            b, _ = self.parse_quietly(descent, q)
+            self.assertEqual(repr(a), repr(b), q)
+            self.assertEqual(a.to_json(), b.to_json(), q)
+            self.assertEqual(ply.tokenize(q), descent.tokenize(q), q)
+
+        # Random token soup: where PLY parses without a syntax error, the results must match;
+        # where it has one, the descent parser must also reject the query
+        words = ["a", "b", "name", '"x y"', "AND", "OR", "NOT", "(", ")", ":", "->", ">=", "=", "$"]
+        rnd = random.Random(42)
+        for _ in range(2000):
+            q = " ".join(rnd.choice(words) for _ in range(rnd.randint(1, 8)))
+            a, msg = self.parse_quietly(ply, q)
+            b, _ = self.parse_quietly(descent, q)
+            if "Syntax error" in msg:
+                self.assertIsNone(b, q)
+            else:
+                self.assertEqual(repr(a), repr(b), q)
+
+    def test_parser_bad_backend(self):
+        self.assertRaises(ValueError, QueryParser, backend="fish")
+
+    def test_parser_threads(self):
+        parser = QueryParser()
+        queries = [q for q in self.parser_corpus if "$" not in q]
+        expected = {q: repr(parser.parse(q)) for q in queries}
+        q = "name:fish AND carries->name:boat"
+        made = {q: parser.make_query(q, "item").to_json()}
+        failures = []
+        barrier = threading.Barrier(8)
+
+        def work(n):
+            barrier.wait()
+            for i in range(200):
+                q = queries[(i + n) % len(queries)]
+                got = repr(parser.parse(q))
+                if got != expected[q]:
+                    failures.append((q, got))
+                for mq, js in made.items():
+                    if parser.make_query(mq, "item").to_json() != js:
+                        failures.append((mq, "make_query"))
+
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(failures, [])
+
+    def test_parser_cache(self):
+        parser = QueryParser(cache_size=2)
+        js = parser.query_json("name:fish", "item")
+        self.assertEqual(js, {"AND": [{"name": "fish"}]})
+        self.assertTrue(parser.query_json("name:fish", "item") is js)
+        self.assertEqual(parser.query_json("name:fish", "work"), js)
+        stats = parser.cache_stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (2, 3))
+        # ast for name:fish, then json for item and work: the oldest has been evicted
+        self.assertEqual(stats["evictions"], 1)
+        self.assertEqual(stats["size"], 2)
+        self.assertIsNone(QueryParser().cache_stats())
+
+    def test_cache_expiry_and_reload(self):
+        from luxql.cache import MISSING, LRUCache
+
+        cache = LRUCache(10, ttl=0.01)
+        cache.put("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        time.sleep(0.02)
+        self.assertTrue(cache.get("a") is MISSING)
+        self.assertEqual(cache.stats()["expirations"], 1)
+
+        fn = os.path.join(os.path.dirname(os.path.abspath(__file__)), "luxql", "advanced-search-config.json")
+        cfg = LuxConfig(default_config, lux_config=fn)
+        cache = LRUCache(10, config=cfg)
+        cache.put("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        cfg.reload()
+        self.assertTrue(cache.get("a") is MISSING)
+
+    def test_config_refresh(self):
+        from luxql.refresh import ConfigRefresher
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cfg = LuxConfig(dict(default_config, snapshot_dir=tmp))
+            fn = os.path.join(os.path.dirname(os.path.abspath(__file__)), "luxql", "advanced-search-config.json")
+            with open(fn) as fh:
+                remote = {cfg.remote_lux_config: json.load(fh), cfg.remote_lux_stats: TEST_STATS}
+            calls = []
+
+            def fetch(url, conditional=False):
+                # Stand-in for the server: everything changes once, then is unchanged
+                calls.append(url)
+                return remote.pop(url, None)
+
+            cfg.fetch = fetch
+            self.assertTrue(cfg.refresh())
+            self.assertEqual(cfg.generation, 1)
+            self.assertTrue("item" in cfg.scopes)
+            self.assertEqual(cfg.lux_stats, TEST_STATS)
+            self.assertFalse(cfg.refresh())
+            self.assertEqual(cfg.generation, 1)
+
+            # A change is swapped in as a whole new state; one already read is left as it was
+            state = cfg.state
+            with open(fn) as fh:
+                changed = json.load(fh)
+            del changed["terms"]["item"]["carries"]
+            remote[cfg.remote_lux_config] = changed
+            self.assertTrue(cfg.refresh())
+            self.assertEqual((state.generation, cfg.generation), (1, 2))
+            self.assertTrue(("item", "carries") in state.index)
+            self.assertFalse(("item", "carries") in cfg.index)
+            self.assertRaises(AttributeError, setattr, state, "index", {})
+
+            refresher = ConfigRefresher(cfg, interval=0.01).start()
+            time.sleep(0.1)
+            refresher.stop()
+            self.assertTrue(len(calls) > 4)
+            self.assertIsNone(refresher.last_error)
+            self.assertIsNotNone(refresher.last_success)
+
+    def test_config_transport(self):
+        from luxql.transport import StaticTransport
+
+        with tempfile.TemporaryDirectory() as tmp:
+            fn = os.path.join(os.path.dirname(os.path.abspath(__file__)), "luxql", "advanced-search-config.json")
+            settings = dict(default_config, snapshot_dir=tmp, allow_network=True)
+            transport = StaticTransport({})
+            cfg = LuxConfig(settings, transport=transport)
+            transport.responses = {cfg.remote_lux_config: fn, cfg.remote_lux_stats: TEST_STATS}
+            # Loading the config fetches the stats alongside it
+            self.assertTrue("item" in cfg.scopes)
+            self.assertEqual(sorted(transport.requests), sorted(transport.responses))
+            self.assertEqual(cfg.lux_stats, TEST_STATS)
+
+            # Failures are reported with the status
+            empty = dict(settings, snapshot_dir=os.path.join(tmp, "empty"))
+            cfg2 = LuxConfig(empty, transport=StaticTransport({}))
+            self.assertRaises(ValueError, cfg2.load_config)
+
+            # A refresh that fails for the stats still applies a changed config
+            with open(fn) as fh:
+                config_v1 = json.load(fh)
+            config_v2 = dict(config_v1, version=2)
+            server = {cfg.remote_lux_config: ("v1", config_v1), cfg.remote_lux_stats: ("s1", TEST_STATS)}
+
+            class VersionedTransport(object):
+                def get(self, url, headers=None):
+                    if url not in server:
+                        return 500, {}, None
+                    etag, data = server[url]
+                    if (headers or {}).get("If-None-Match") == etag:
+                        return 304, {"ETag": etag}, None
+                    return 200, {"ETag": etag}, data
+
+            cfg.transport = VersionedTransport()
+            self.assertTrue(cfg.refresh())
+            server[cfg.remote_lux_config] = ("v2", config_v2)
+            del server[cfg.remote_lux_stats]
+            self.assertRaises(ValueError, cfg.refresh)
+            self.assertEqual(cfg.lux_config.get("version"), 2)
+            self.assertEqual(cfg.validators[cfg.remote_lux_config], {"ETag": "v2"})
+
+        # The shared transport is per pool size and timeout
+        from luxql.transport import shared_transport
+
+        self.assertIs(shared_transport(3, 5), shared_transport(3, 5))
+        self.assertIsNot(shared_transport(3, 5), shared_transport(4, 5))
+        self.assertEqual((shared_transport(4, 7).pool_size, shared_transport(4, 7).timeout), (4, 7))
+
+    def test_generator(self):
+        from luxql.generator import QueryGenerator
+
+        reader = JsonReader(LuxAPI("item").config)
+        gen = QueryGenerator(seed=5, max_depth=4)
+        queries = list(gen.queries(300))
+        self.assertEqual(queries, list(QueryGenerator(seed=5, max_depth=4).queries(300)))
+        for scope, q in queries:
+            self.assertEqual(reader.validate(q, scope), (True, None))
+
+        # Query strings parse to the same query as the JSON
+        parser = QueryParser()
+        gen = QueryGenerator(seed=6, max_depth=4, string_safe=True)
+        for scope, q in gen.queries(300):
+            parsed = parser.make_query(gen.query_string(q), scope)
+            self.assertEqual(parsed.structural_hash(), reader.read(q, scope).structural_hash())
+
+        gen = QueryGenerator(seed=7, leaf_types=["date"], scopes=["item"], max_depth=0)
+        scope, q = gen.generate()
+        self.assertEqual(scope, "item")
+        self.assertTrue("_comp" in q)
+        self.assertRaises(ValueError, gen.query_string, {"name": "fish", "_options": ["stemmed"]})
+        self.assertRaises(ValueError, QueryGenerator, scopes=["fish"])
+
+    def test_instrument(self):
+        from luxql import instrument
+
+        self.assertFalse(instrument.enabled)
+        for backend in ("ply", "descent"):
+            parser = QueryParser(backend=backend)
+            with instrument.recording() as rec:
+                self.assertTrue(instrument.enabled)
+                q = parser.make_query('name:fish AND carries->name:boat AND producedDate>"1900-01-01"', "item")
+                q.parent.to_json()
+                q.calculate_complexity()
+                self.assertRaises(ValueError, parser.make_query, "isOnline:fish", "item")
+            self.assertFalse(instrument.enabled)
+            stats = rec.as_dict()
+            for st in ("lex", "parse", "to_luxql", "validation", "complexity", "to_json"):
+                self.assertTrue(stats["stages"][st]["count"] > 0, st)
+            # Recursive stages are only timed at the outermost call
+            self.assertEqual(stats["stages"]["to_json"]["count"], 1)
+            self.assertEqual(stats["counters"]["validation_errors"], 1)
+            self.assertEqual(stats["counters"]["tokens"], 16)
+            self.assertEqual(sum(rec.histograms()["parse"]["counts"]), 2)
+
+        # Process wide recorders see every thread
+        rec = instrument.add_recorder(instrument.Recorder())
+        try:
+            t = threading.Thread(target=QueryParser().make_query, args=("name:fish", "item"))
+            t.start()
+            t.join()
+        finally:
+            instrument.remove_recorder(rec)
+        self.assertFalse(instrument.enabled)
+        self.assertEqual(rec.as_dict()["stages"]["parse"]["count"], 1)
+
+    def test_json_bytes(self):
+        from luxql.generator import QueryGenerator
+
+        reader = JsonReader(LuxAPI("item").config)
+        for scope, q in QueryGenerator(seed=8, max_depth=4, option_rate=0.5).queries(200):
+            top = reader.read(q, scope)
+            self.assertEqual(top.to_json_bytes(), json.dumps(top.to_json()).encode("utf-8"))
+            top.invalidate()
+            fh = io.StringIO()
+            top.parent.write_json(fh)
+            self.assertEqual(fh.getvalue(), json.dumps(top.parent.to_json()))
+
+        leaf = LuxLeaf("name", value='caf\u00e9 "x"', options=["stemmed"], weight=2, complete=True)
+        self.assertEqual(leaf.to_json_bytes(), json.dumps(leaf.to_json()).encode("utf-8"))
+        self.assertEqual(leaf.to_json(encoded=True), leaf.to_json_bytes())
+        self.assertRaises(ValueError, LuxBoolean("AND").to_json_bytes)
+
+        # Adding to the tree, however deep, drops encodings cached above
+        api = LuxAPI("item")
+        bl = LuxBoolean("AND", parent=api)
+        rel = LuxRelationship("producedBy", parent=bl)
+        bl2 = LuxBoolean("OR", parent=rel)
+        LuxLeaf("name", value="fish", parent=bl2)
+        api.to_json_bytes()
+        LuxLeaf("name", value="boat", parent=bl)
+        LuxLeaf("name", value="smith", parent=bl2)
+        self.assertEqual(api.to_json_bytes(), json.dumps(api.to_json()).encode("utf-8"))
+        self.assertEqual(api.to_json(encoded=True), api.to_json_bytes())
+        fh = io.StringIO()
+        api.write_json(fh)
+        self.assertEqual(fh.getvalue(), json.dumps(api.to_json()))
+        self.assertTrue(b"smith" in api.to_json_bytes() and b"boat" in api.to_json_bytes())
+
+    def test_deep_trees(self):
+        from luxql.optimizer import is_unsatisfiable
+        from luxql.string_parser import print_ast
+
+        depth = 5000
+        parser = QueryParser()
+        chain = parser.make_query("producedBy->" + "memberOf->" * depth + "name:smith", "item")
+        self.assertTrue(chain.calculate_complexity() > depth)
+        self.assertTrue(chain.to_json_bytes().endswith(b'{"name": "smith"}' + b"}" * (depth + 1) + b"]}"))
+
+        ands = parser.parse(" AND ".join(f"name:a{i}" for i in range(depth)))
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            print_ast(ands)
+        self.assertEqual(len(out.getvalue().splitlines()), 2 * depth - 1)
+        top = ands.to_luxql(LuxAPI("item"))
+        reader = JsonReader(LuxAPI("item").config)
+        self.assertEqual(top.calculate_complexity(), reader.read(top.to_json(), "item").calculate_complexity())
+
+        query = {"name": "fish"}
+        for i in range(depth):
+            query = {"NOT": [query]} if i % 2 else {"AND": [query, {"name": f"b{i}"}]}
+        self.assertEqual(reader.validate(query, "item"), (True, None))
+        read = reader.read(query, "item")
+        self.assertTrue(read.to_json_bytes().startswith(b'{"NOT": [{"AND": [{"NOT": '))
+        self.assertEqual(read.to_json(encoded=True), read.to_json_bytes())
+        self.assertEqual(len(read.structural_hash()), 40)
+        self.assertTrue(read.canonical_key().startswith('{"NOT":[{"AND":[{"NOT":'))
+        optimize(read.parent)
+        self.assertFalse(is_unsatisfiable(read.parent))
+        before = chain.parent.structural_hash()
+        self.assertEqual(optimize(chain.parent).structural_hash(), before)
+
+        # Both parser backends handle deep nesting, and agree
+        for q in ("NOT " * depth + "name:a", "(" * depth + "name:a OR NOT (name:b)" + ")" * depth):
+            ply, descent = [QueryParser(backend=b).parse(q).to_luxql(LuxAPI("item")) for b in ("ply", "descent")]
+            self.assertEqual(ply.to_json_bytes(), descent.to_json_bytes())
+
+    def test_prepared(self):
+        parser = QueryParser()
+        prepared = parser.prepare('producedBy->name:$1 AND producedDate>=$2 AND (name:"$1" OR isOnline:1)', "item")
+        js = prepared.bind("rembrandt", "1600-01-01")
+        query = 'producedBy->name:rembrandt AND producedDate>="1600-01-01" AND (name:rembrandt OR isOnline:1)'
+        self.assertEqual(js, json.dumps(parser.make_query(query, "item").parent.to_json()))
+        self.assertEqual(prepared.bind("a", "1600", encoded=True), prepared.bind("a", "1600").encode("utf-8"))
+        self.assertEqual(prepared.complexity(), parser.make_query(query, "item").calculate_complexity())
+        # Values get the checks they would have when building the query
+        self.assertRaises(ValueError, prepared.bind, "rembrandt", "fish")
+        self.assertRaises(ValueError, prepared.bind, "rembrandt")
+        self.assertRaises(ValueError, parser.prepare, "name:$2", "item")
+        # Only whole values are placeholders
+        prepared = parser.prepare('name:"costs $5" AND name:$1', "item")
+        self.assertEqual(json.loads(prepared.bind("fish"))["AND"][0], {"name": "costs $5"})
+        self.assertRaises(ValueError, parser.prepare, "name:$1x", "item")
+        self.assertRaises(ValueError, parser.prepare, "name:a$1", "item")
+        # Templates must parse cleanly, rather than with clauses dropped by error recovery
+        for backend in ("ply", "descent"):
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                for bad in ("name:$1 AND AND producedDate>=$1", "name:$1 AND", "name:$1 ~ name:fish"):
+                    self.assertRaisesRegex(
+                        ValueError, "Couldn't parse", QueryParser(backend=backend).prepare, bad, "item"
+                    )
+            self.assertEqual(out.getvalue(), "")
+
+        reader = JsonReader(LuxAPI("item").config)
+        prepared = reader.prepare(
+            {"AND": [{"name": "$1", "_options": ["stemmed"]}, {"height": "$2", "_comp": ">"}, {"name": "$"}]},
+            "item",
+        )
+        self.assertEqual(
+            json.loads(prepared.bind("boat", 3.5)),
+            reader.read(
+                {
+                    "AND": [
+                        {"name": "boat", "_options": ["stemmed"]},
+                        {"height": "3.5", "_comp": ">"},
+                        {"name": "$"},
+                    ]
+                },
+                "item",
+            ).to_json(),
+        )
+        self.assertRaises(ValueError, prepared.bind, 7, 3.5)
+        self.assertRaises(ValueError, prepared.bind, "boat", "tall")
+
+    def test_complexity_budget(self):
+        from luxql import instrument
+
+        reader = JsonReader(LuxAPI("item").config)
+        parser = QueryParser()
+        query = {"AND": [{"name": "fish"}, {"carries": {"name": "boat"}}, {"producedDate": "1900", "_comp": ">"}]}
+        full = reader.read(query, "item").calculate_complexity()
+        # The running total matches a full calculation, and the budget is inclusive
+        self.assertEqual(reader.read(query, "item", budget=full).parent.complexity, full)
+        self.assertRaises(ValueError, reader.read, query, "item", budget=full - 1)
+        q = 'name:fish AND carries->name:boat AND producedDate>"1900"'
+        full = parser.make_query(q, "item").calculate_complexity()
+        self.assertEqual(parser.make_query(q, "item", budget=full).parent.complexity, full)
+        self.assertRaises(ValueError, parser.make_query, q, "item", budget=full - 1)
+
+        # Construction stops as soon as the budget is exceeded
+        wide = {"OR": [{"name": f"fish {i}"} for i in range(2000)]}
+        with instrument.recording() as rec:
+            self.assertRaises(ValueError, reader.read, wide, "item", budget=50)
+        self.assertTrue(rec.as_dict()["counters"]["nodes"] < 100)
+
+        api = LuxAPI("item", budget=5)
+        self.assertRaises(ValueError, LuxLeaf, "producedDate", parent=api, value="1900", comparitor=">")
+
+        # The budget still holds once the cached complexities have been dropped
+        from luxql.optimizer import optimize
+
+        full = reader.read(query, "item").calculate_complexity()
+        for reset in (lambda top: top.invalidate(), lambda top: optimize(top.parent)):
+            top = reader.read(query, "item", budget=full)
+            reset(top)
+            self.assertRaises(ValueError, LuxLeaf, "name", parent=top.parent.children[0], value="boat")
+        top = reader.read(query, "item", budget=full)
+        top.invalidate()
+        self.assertEqual(top.parent.calculate_complexity(), full)
+        top.parent.budget = full - 1
+        top.invalidate()
+        self.assertRaises(ValueError, top.parent.calculate_complexity)
+
+    def test_wire(self):
+        from luxql import wire
+        from luxql.generator import QueryGenerator
+        from luxql.luxql import post_order
+        from luxql.prepared import leaves
+
+        def scopes(node):
+            found = []
+            stack = [node]
+            while stack:
+                node = stack.pop()
+                found.append(
+                    (node.field, node.provides_scope, node.possible_parent_scopes, node.possible_provides_scopes)
+                )
+                stack.extend(node.children or ())
+            return found
+
+        reader = JsonReader(LuxAPI("item").config)
+        sizes = [0, 0]
+        for scope, q in QueryGenerator(seed=9, max_depth=4, option_rate=0.5).queries(200):
+            top = reader.read(q, scope)
+            data = wire.dumps(top.parent)
+            sizes[0] += len(data)
+            sizes[1] += len(top.to_json_bytes())
+            api = wire.loads(data)
+            self.assertEqual(api.provides_scope, scope)
+            self.assertEqual(api.to_json(), top.parent.to_json())
+            self.assertEqual(api.calculate_complexity(), top.parent.calculate_complexity())
+            self.assertEqual(scopes(api.children[0]), scopes(top))
+        self.assertTrue(sizes[0] < sizes[1] / 2)
+
+        leaf = LuxLeaf("name", value="café", options=["stemmed"], weight=2.5, complete=True)
+        self.assertEqual(wire.loads(wire.dumps(leaf)).to_json(), leaf.to_json())
+
+        deep = QueryParser().make_query("producedBy->" + "memberOf->" * 5000 + "name:smith", "item")
+        self.assertEqual(len(leaves(wire.loads(wire.dumps(deep)))), 1)
+
+        # Values keep their type
+        api = LuxAPI("item")
+        bl = LuxBoolean("AND", parent=api)
+        values = [
+            LuxLeaf("height", value=10, comparitor=">", parent=bl),
+            LuxLeaf("isOnline", value=True, parent=bl),
+        ]
+        values.append(LuxLeaf("width", value=2.5, comparitor="<", parent=bl))
+        decoded = wire.loads(wire.dumps(api)).children[0].children
+        self.assertEqual([(type(x.value), x.value) for x in decoded], [(type(x.value), x.value) for x in values])
+
+        # Decoded nodes have every slot the constructors give them
+        def slots(node):
+            names = [n for c in type(node).__mro__ for n in getattr(c, "__slots__", ())]
+            return {n: getattr(node, n) for n in names if n not in ("parent", "children")}
+
+        for built, restored in zip(post_order(api), post_order(wire.loads(wire.dumps(api)))):
+            self.assertEqual(slots(restored), slots(built))
+
+        # Data from another configuration, or that isn't an encoded query, is rejected
+        data = bytearray(wire.dumps(deep))
+        data[3] ^= 0xFF
+        self.assertRaises(ValueError, wire.loads, bytes(data))
+        # As is any truncation or corruption
+        data = wire.dumps(reader.read(QueryGenerator(seed=10, max_depth=3).generate("item")[1], "item").parent)
+        for n in range(len(data)):
+            self.assertRaises(ValueError, wire.loads, data[:n])
+        rnd = random.Random(11)
+        for _ in range(500):
+            corrupt = bytearray(data)
+            corrupt[rnd.randrange(11, len(data))] = rnd.randrange(256)
+            try:
+                wire.loads(bytes(corrupt))
+            except ValueError:
+                pass
+        self.assertRaises(ValueError, wire.loads, b'{"name": "fish"}')
+        self.assertRaises(ValueError, wire.dumps, LuxAPI("item"))
+
 
 # api = LuxAPI('item')
 # bl = LuxBoolean('AND')